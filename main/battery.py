@@ -0,0 +1,211 @@
+#! /usr/bin/env python
+#
+# MicroPython USMART Battery. Measures the battery voltage and hibernates through a low battery.
+#
+# This file is part of micropython-usmart-sensor-application.
+# https://github.com/bensherlock/micropython-usmart-sensor-application
+#
+#
+# MIT License
+#
+# Copyright (c) 2020 Benjamin Sherlock <benjamin.sherlock@ncl.ac.uk>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""MicroPython USMART Battery."""
+
+import machine
+import pyb
+import utime
+from array import array
+import hibernation
+
+# Hibernate below the cutoff and only resume once the battery is back above the resume voltage, so that a battery
+# hovering around the cutoff doesn't bring the node in and out of hibernation.
+VBATT_CUTOFF = 3.6
+VBATT_RESUME = 3.8
+# How often to wake from hibernation to check the battery.
+HIBERNATE_WAKE_MS = 3600000
+
+# Battery measurement, see measure_vbatt()
+VBATT_MIN_SAMPLES = 8
+VBATT_MAX_SAMPLES = 64
+VBATT_SAMPLE_INTERVAL_MS = 10
+VBATT_TOLERANCE = 0.005  # Volts
+VBATT_DEADLINE_MS = 2000
+VBATT_MARGIN = 0.1  # Volts either side of a threshold where the measurement always runs to the deadline.
+_vbatt_samples = array('f', [0.0] * VBATT_MAX_SAMPLES)
+
+
+def low_power_pins(disable_3v3=False, disable_leds=False):
+    # from https://github.com/micropython/micropython/issues/4686
+    pins = [
+        # user IO pins
+        'A0', 'A1', 'A2', 'A3', 'A4', 'A5', 'A6', 'A7', 'A8', 'A9', 'A10', 'A11', 'A12', 'A13', 'A14', 'A15',
+        'B0', 'B1', 'B3', 'B4', 'B5', 'B7', 'B8', 'B9', 'B10', 'B11', 'B12', 'B13',
+        'C0', 'C1', 'C2', 'C3', 'C4', 'C5', 'C6',
+        'D0', 'D3', 'D8', 'D9',
+        'E0', 'E1', 'E12', 'E14', 'E15',
+        'F1', 'F6', 'F7', 'F8', 'F9', 'F10', 'F11', 'F13', 'F14', 'F15',
+        'H2', 'H3', 'H5', 'H6', 'H7', 'H8',
+        'I0', 'I1',
+
+        # internal pins
+        'D1', 'D14', 'D15',
+        'F0', 'F12',
+        'G0', 'G1', 'G2', 'G3', 'G4', 'G5', #'G6',
+        'H4', 'H9', 'H10', 'H11', 'H12', 'H13', 'H14', 'H15',
+        'I2', 'I3',
+    ]
+    pins_led = ['F3', 'F4', 'F5',]
+    pins_sdmmc = ['D6', 'D7', 'G9', 'G10', 'G11', 'G12']
+    pins_wlan = ['D2', 'D4', 'I7', 'I8', 'I9', 'I11']
+    pins_bt = ['D5', 'D10', 'E3', 'E4', 'E5', 'E6', 'G8', 'G13', 'G14', 'G15', 'I4', 'I5', 'I6', 'I10']
+    pins_qspi1 = ['B2', 'B6', 'D11', 'D12', 'D13', 'E2']
+    pins_qspi2 = ['E7', 'E8', 'E9', 'E10', 'E11', 'E13']
+    for p in pins:
+        pyb.Pin(p, pyb.Pin.IN, pyb.Pin.PULL_DOWN)
+    if disable_3v3:
+       pyb.Pin('EN_3V3', pyb.Pin.IN, None)
+    if disable_leds:
+        for p in pins_led:
+            pyb.Pin(p, pyb.Pin.IN, pyb.Pin.PULL_UP)
+
+def measure_vbatt(powermodule, thresholds=(VBATT_CUTOFF,)):
+    """Measure the battery voltage, sampling until the reading has settled rather than waiting a fixed time.
+    Samples are taken every VBATT_SAMPLE_INTERVAL_MS into a preallocated array with a running mean and variance.
+    While the voltage at the ADC is still settling the samples drift, or step between the older and newer half, by
+    more than their noise explains, and the older half is dropped. The reading has settled once the drift and the
+    standard error of the mean are within VBATT_TOLERANCE, and the mean of the next VBATT_MIN_SAMPLES agrees with it.
+    A slow tail can still look flat over that long, so within VBATT_MARGIN of any of the thresholds the voltage is to be
+    compared with it samples on to VBATT_DEADLINE_MS, keeping the newest samples once the array is full.
+    Returns (volts, number of samples taken)."""
+    import math
+    samples = _vbatt_samples
+    start = utime.ticks_ms()
+    taken = 0
+    n = 0
+    mean = 0.0
+    m2 = 0.0
+    settled_n = 0  # Samples in the window when it first looked settled, 0 if it hasn't.
+    settled_mean = 0.0
+    while True:
+        sample = powermodule.get_vbatt_reading()
+        taken += 1
+        samples[n] = sample
+        n += 1
+        # Welford's running mean and variance
+        delta = sample - mean
+        mean += delta / n
+        m2 += delta * (sample - mean)
+
+        near_threshold = False
+        for threshold in thresholds:
+            if abs(mean - threshold) < VBATT_MARGIN:
+                near_threshold = True
+
+        settling = False
+        if n >= VBATT_MIN_SAMPLES:
+            # Least squares slope against the sample number, with the residual variance about the line.
+            sxy = 0.0
+            for i in range(n):
+                sxy += (i - (n - 1) / 2) * (samples[i] - mean)
+            sxx = n * (n * n - 1) / 12
+            slope = sxy / sxx
+            residual_variance = max(m2 - slope * sxy, 0.0) / (n - 2)
+            drift = abs(slope) * n  # Change in the voltage over the samples.
+            # And the step between the means of the older and newer halves, against the noise of the newer half.
+            half = n // 2
+            older = 0.0
+            for i in range(half):
+                older += samples[i]
+            older /= half
+            newer = (mean * n - older * half) / (n - half)
+            newer_m2 = 0.0
+            for i in range(half, n):
+                newer_m2 += (samples[i] - newer) * (samples[i] - newer)
+            step_noise = math.sqrt(newer_m2 / (n - half - 1) * (1 / half + 1 / (n - half)))
+            if (drift > VBATT_TOLERANCE + 2 * n * math.sqrt(residual_variance / sxx)
+                    or abs(newer - older) > VBATT_TOLERANCE + 3 * step_noise):
+                settling = True
+            elif drift <= VBATT_TOLERANCE and m2 / (n - 1) / n <= VBATT_TOLERANCE * VBATT_TOLERANCE:
+                if not settled_n:
+                    settled_n = n
+                    settled_mean = mean
+                elif n - settled_n >= VBATT_MIN_SAMPLES:
+                    # Compare the samples since with the window that first looked settled.
+                    since = (mean * n - settled_mean * settled_n) / (n - settled_n)
+                    if abs(since - settled_mean) > VBATT_TOLERANCE:
+                        settling = True
+                    elif not near_threshold:
+                        return mean, taken
+
+        if utime.ticks_diff(utime.ticks_ms(), start) >= VBATT_DEADLINE_MS:
+            return mean, taken
+        if n == VBATT_MAX_SAMPLES:
+            if not near_threshold:
+                return mean, taken
+            settling = True  # Keep the newer half and sample on.
+
+        if settling:
+            # Start again from the newer half.
+            half = n // 2
+            mean = 0.0
+            m2 = 0.0
+            for i in range(n - half):
+                samples[i] = samples[half + i]
+                delta = samples[i] - mean
+                mean += delta / (i + 1)
+                m2 += delta * (samples[i] - mean)
+            n -= half
+            settled_n = 0
+
+        utime.sleep_ms(VBATT_SAMPLE_INTERVAL_MS)
+
+
+def hibernate(powermodule):
+    """Power down all peripherals and deepsleep until the RTC wakes us to check the battery again. Doesn't return."""
+    # Turn off the USB
+    pyb.usb_mode(None)
+
+    low_power_pins(disable_3v3=True, disable_leds=True)
+
+    powermodule.disable_nm3() # Needs to be driven low in order to pull-down the external resistor.
+
+    hibernation.hibernate(HIBERNATE_WAKE_MS)
+
+
+def recheck_hibernation():
+    """Check the battery on an RTC wake from hibernation, called from boot.py so that main.py and the modules it imports
+    are only loaded once the battery has recovered. Deepsleeps again while it is below VBATT_RESUME, otherwise resets to
+    boot from the top with the SD card mounted. Doesn't return."""
+    try:
+        from pybd_expansion.main.powermodule import PowerModule
+        powermodule = PowerModule()
+        vbatt_volts, vbatt_samples = measure_vbatt(powermodule, (VBATT_RESUME,))
+        if vbatt_volts < VBATT_RESUME:
+            hibernate(powermodule)
+    except Exception as the_exception:
+        import sys
+        sys.print_exception(the_exception)
+        pass
+
+    # Recovered, or can't check the battery, so boot again from the top.
+    hibernation.resume()
+    machine.reset()
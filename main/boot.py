@@ -5,6 +5,9 @@ import machine
 import pyb
 import os
 import utime
+import phasetimer
+phasetimer.get_phase_timer()  # Start timing the boot phases
+import hibernation
 pyb.country('GB')  # ISO 3166-1 Alpha-2 code, eg US, GB, DE, AU
 
 
@@ -25,7 +28,13 @@ pyb.country('GB')  # ISO 3166-1 Alpha-2 code, eg US, GB, DE, AU
 pyb.Pin.board.EN_3V3.on()
 utime.sleep_ms(10)
 
-if pyb.SDCard().present():
+if hibernation.is_hibernating():
+    # Woken from hibernation just to check the battery, so leave the SD card unmounted and the USB off, and go back to
+    # sleep from here rather than loading main.py while the battery is still low.
+    pyb.usb_mode(None)
+    import battery
+    battery.recheck_hibernation()  # Doesn't return.
+elif pyb.SDCard().present():
     # Extra delay to let the SDCard start up before mounting.
     utime.sleep_ms(500)
     os.mount(pyb.SDCard(), '/sd')
@@ -33,5 +42,7 @@ if pyb.SDCard().present():
 else:
     pyb.usb_mode('VCP+MSC')  # act as a serial and a storage device
 
+phasetimer.get_phase_timer().mark('sd_mount')
+
 pyb.main('main.py')  # main script to run after this one run after this one
 
@@ -0,0 +1,92 @@
+#! /usr/bin/env python
+#
+# MicroPython USMART Configuration. Loads all the config files once per boot.
+#
+# This file is part of micropython-usmart-sensor-application.
+# https://github.com/bensherlock/micropython-usmart-sensor-application
+#
+#
+# MIT License
+#
+# Copyright (c) 2020 Benjamin Sherlock <benjamin.sherlock@ncl.ac.uk>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""MicroPython USMART Configuration."""
+
+import json
+import os
+import jotter
+
+CONFIG_PATH = 'config'
+MODULE_CONFIG_SUFFIX = '_gitrepo_cfg.json'
+
+_config = None
+
+
+def load_json_config(filename):
+    """Load a single JSON config file. Returns None, and jots why, if it can't be read."""
+    try:
+        with open(filename) as json_config_file:
+            return json.load(json_config_file)
+    except Exception as the_exception:
+        print('Unable to load ' + filename)
+        jotter.get_jotter().jot('Unable to load ' + filename + ': ' + str(the_exception), source_file=__name__)
+    return None
+
+
+def load_json_configs(config_path=CONFIG_PATH):
+    """Load and merge all the JSON config files in the config directory.
+    Returns {'wifi': wifi_cfg, 'startup': startup_cfg, 'modules': {module_name: gitrepo_cfg}}."""
+    config = {'wifi': None, 'startup': None, 'modules': {}}
+    try:
+        filenames = os.listdir(config_path)
+    except OSError:
+        return config
+
+    for filename in filenames:
+        if filename.endswith(MODULE_CONFIG_SUFFIX):
+            module_cfg = load_json_config(config_path + '/' + filename)
+            if module_cfg:
+                config['modules'][filename[:-len(MODULE_CONFIG_SUFFIX)]] = module_cfg
+        elif filename == 'wifi_cfg.json':
+            config['wifi'] = load_json_config(config_path + '/' + filename)
+        elif filename == 'startup_cfg.json':
+            config['startup'] = load_json_config(config_path + '/' + filename)
+    return config
+
+
+def get_config():
+    """Get the merged configuration, loaded on the first call.
+    A precompiled config_compiled.py (or .mpy) made by scripts/compileconfig.py is used in preference to the JSON
+    files as importing it needs no JSON parsing. Delete it to go back to the JSON files."""
+    global _config
+
+    if _config is None:
+        try:
+            from config_compiled import CONFIG
+            _config = CONFIG
+        except ImportError:
+            _config = load_json_configs()
+    return _config
+
+
+def get_module_config(module_name):
+    """Get the OTA configuration of the module or None."""
+    return get_config()['modules'].get(module_name)
@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+#
+# MicroPython USMART Hibernation. Deepsleeps through a low battery, waking on the RTC to check it again.
+#
+# This file is part of micropython-usmart-sensor-application.
+# https://github.com/bensherlock/micropython-usmart-sensor-application
+#
+#
+# MIT License
+#
+# Copyright (c) 2020 Benjamin Sherlock <benjamin.sherlock@ncl.ac.uk>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""MicroPython USMART Hibernation."""
+
+import machine
+
+# The state is kept in an RTC backup register, which keeps its value through deepsleep, so a wake-up needs neither the
+# SD card nor a write to flash. The upper half holds one of the magic numbers below and the lower half the count of
+# wake-ups while hibernating.
+BACKUP_REGISTER = 5
+HIBERNATING = 0x4842
+RESUMED = 0x5245
+
+
+def _address():
+    import stm
+    return stm.RTC + stm.RTC_BKP0R + 4 * BACKUP_REGISTER
+
+
+def get_state():
+    """Get (magic, wake-ups) from the backup register. The magic is 0 if neither is set."""
+    import stm
+    value = stm.mem32[_address()]
+    magic = (value >> 16) & 0xFFFF
+    if magic != HIBERNATING and magic != RESUMED:
+        return 0, 0
+    return magic, value & 0xFFFF
+
+
+def set_state(magic, wakeups=0):
+    """Set the magic and wake-up count in the backup register."""
+    import stm
+    # Writes to the backup domain are already enabled by the firmware starting the RTC.
+    stm.mem32[_address()] = (magic << 16) | min(wakeups, 0xFFFF)
+
+
+def clear():
+    set_state(0)
+
+
+def is_hibernating():
+    """True if this boot is the RTC waking us from hibernation to check the battery."""
+    return machine.reset_cause() == machine.DEEPSLEEP_RESET and get_state()[0] == HIBERNATING
+
+
+def hibernate(wake_ms):
+    """Deepsleep until the RTC wakes us after wake_ms, counting the wake-up. Doesn't return."""
+    magic, wakeups = get_state()
+    set_state(HIBERNATING, wakeups + 1 if magic == HIBERNATING else 0)
+    machine.deepsleep(wake_ms)
+
+
+def resume():
+    """Leave hibernation, keeping the count of wake-ups for the next boot to report."""
+    magic, wakeups = get_state()
+    set_state(RESUMED, wakeups)
+
+
+def take_resumed_wakeups():
+    """Get the number of wake-ups spent hibernating if we have just resumed, otherwise None. Clears the state."""
+    magic, wakeups = get_state()
+    if magic == RESUMED:
+        clear()
+        return wakeups
+    return None
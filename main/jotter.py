@@ -32,18 +32,42 @@
 
 import os
 import utime
-from ucollections import deque
+import ustruct
 
 _jotters = {}
 
+# Binary record header: kind, level, seconds since 2000-01-01, source id, payload length.
+# Decoded on the host by scripts/decodejotter.py
+RECORD_HEADER_FORMAT = '<BBIHH'
+RECORD_HEADER_SIZE = 10
+RECORD_KIND_ENTRY = 0
+RECORD_KIND_SOURCE = 1  # Defines the source file name for a source id. Payload is the name.
+LEVEL_INFO = 0
+LEVEL_EXCEPTION = 1
+
 
 class Jotter:
     """Jotter."""
 
-    def __init__(self, name):
+    def __init__(self, name, buffer_size=0, flush_interval_ms=60000, max_size=1048576, retention=8, binary=False):
+        """With a buffer_size the entries are collected in RAM and written to the card in one go when the buffer fills,
+        flush_interval_ms has passed since the last write, or flush() is called.
+        Once the log reaches max_size bytes it is rotated to <name>.1.log and so on, keeping retention old files.
+        A max_size of 0 lets the log grow without limit.
+        If binary the entries are written as packed records to <name>.bin instead of text lines."""
         self._name = name
         self._logs_path = "/sd/logs"
-        self._filename = "/sd/logs/" + name + ".log"
+        self._extension = ".bin" if binary else ".log"
+        self._filename = "/sd/logs/" + name + self._extension
+        self._binary = binary
+        self._record_header = bytearray(RECORD_HEADER_SIZE)
+        self._source_ids = {}
+        self._buffer = bytearray(buffer_size) if buffer_size else None
+        self._buffer_len = 0
+        self._flush_interval_ms = flush_interval_ms
+        self._last_flush = utime.ticks_ms()
+        self._max_size = max_size
+        self._retention = retention
 
         # make directories
         try:
@@ -51,8 +75,17 @@ class Jotter:
         except OSError:
             pass
 
+        # Track the size here rather than stat the file on every jot.
+        try:
+            self._size = os.stat(self._filename)[6]
+        except OSError:
+            self._size = 0
+
     def clear(self):
         """Clear the contents"""
+        self._buffer_len = 0
+        self._size = 0
+        self._source_ids = {}
         try:
             with open(self._filename, 'w') as f:
                 # Open as overwrite
@@ -60,37 +93,154 @@ class Jotter:
         except OSError:
             pass
 
-    def jot(self, msg, source_file="", line_no="", function_name=""):
-        """Jot an entry. Use source_file==__name__ when you call this function."""
-        # exc_info = sys.exc_info()
+    def rotate(self):
+        """Move the log to <name>.1.log, shifting the older logs along and removing any beyond the retention count."""
+        base = self._logs_path + "/" + self._name
+        for i in range(self._retention, 0, -1):
+            try:
+                if i == self._retention:
+                    os.remove(base + "." + str(i) + self._extension)
+                else:
+                    os.rename(base + "." + str(i) + self._extension, base + "." + str(i + 1) + self._extension)
+            except OSError:
+                pass
         try:
-            bufsize = 1
-            with open(self._filename, 'a', buffering=bufsize) as f:
-                timestamp_str = "%d-%02d-%02d %02d:%02d:%02d" % utime.localtime()[:6]
-                f.write(timestamp_str + " - ")
-                if source_file:
-                    f.write(source_file + " - ")
-                if line_no:
-                    f.write(line_no + " - ")
-                if function_name:
-                    f.write(function_name + " - ")
-                f.write(msg + "\n")
+            if self._retention:
+                os.rename(self._filename, base + ".1" + self._extension)
+            else:
+                os.remove(self._filename)
         except OSError:
             pass
+        self._size = 0
 
-    def jot_exception(self, e):
+    def _append(self, data, more=None):
+        """Append the bytes, then the more bytes if given, to the file, rotating first if they would take it past the
+        maximum size."""
+        size = len(data) + (len(more) if more is not None else 0)
+        if self._max_size and self._size and (self._size + size > self._max_size):
+            self.rotate()
+            if self._binary and self._source_ids:
+                # Start the new file with the source names so it can be decoded on its own.
+                definitions = b''
+                for (source_file, source_id) in self._source_ids.items():
+                    definitions += self._pack_record(RECORD_KIND_SOURCE, LEVEL_INFO, source_id, source_file.encode())
+                self._append(definitions)
         try:
-            bufsize = 1
-            with open(self._filename, 'a', buffering=bufsize) as f:
-                import sys
-                timestamp_str = "%d-%02d-%02d %02d:%02d:%02d" % utime.localtime()[:6]
-                f.write(timestamp_str + " ")
-                sys.print_exception(e, f)
+            with open(self._filename, 'ab') as f:
+                f.write(data)
+                if more is not None:
+                    f.write(more)
+            self._size += size
         except OSError:
             pass
 
+    def flush(self):
+        """Write out any buffered entries."""
+        if self._buffer_len:
+            self._append(memoryview(self._buffer)[:self._buffer_len])
+            self._buffer_len = 0
+        self._last_flush = utime.ticks_ms()
+
+    def _write(self, entry):
+        """Append the entry to the file, or to the buffer if buffered."""
+        self._write_bytes(entry.encode())
+
+    def _write_bytes(self, data):
+        """Append the bytes to the file, or to the buffer if buffered."""
+        if self._buffer is None:
+            self._append(data)
+            return
+
+        if self._buffer_len + len(data) > len(self._buffer):
+            self.flush()
+        if len(data) > len(self._buffer):
+            # Too big for the buffer so write it straight out.
+            self._append(data)
+        else:
+            self._buffer[self._buffer_len:self._buffer_len + len(data)] = data
+            self._buffer_len += len(data)
+
+        if utime.ticks_diff(utime.ticks_ms(), self._last_flush) >= self._flush_interval_ms:
+            self.flush()
+
+    def _pack_record(self, kind, level, source_id, payload):
+        """Return the record bytes. Only for the source definitions at the start of a rotated file, jots go through
+        _write_record()."""
+        if len(payload) > 0xFFFF:
+            payload = payload[:0xFFFF]
+        return ustruct.pack(RECORD_HEADER_FORMAT, kind, level, utime.time(), source_id, len(payload)) + payload
+
+    def _write_record(self, kind, level, source_id, payload):
+        """Write a binary record of the payload bytes without assembling it in a new object. Buffered, the header is
+        packed straight into the buffer with the payload copied in after it. Otherwise, or if the record is too big
+        for the buffer, the header is packed into the reusable header buffer and written out ahead of the payload."""
+        n = len(payload)
+        if n > 0xFFFF:
+            payload = memoryview(payload)[:0xFFFF]
+            n = 0xFFFF
+        size = RECORD_HEADER_SIZE + n
+        if self._buffer is not None and size <= len(self._buffer):
+            if self._buffer_len + size > len(self._buffer):
+                self.flush()
+            ustruct.pack_into(RECORD_HEADER_FORMAT, self._buffer, self._buffer_len, kind, level, utime.time(),
+                              source_id, n)
+            self._buffer[self._buffer_len + RECORD_HEADER_SIZE:self._buffer_len + size] = payload
+            self._buffer_len += size
+            if utime.ticks_diff(utime.ticks_ms(), self._last_flush) >= self._flush_interval_ms:
+                self.flush()
+            return
+
+        if self._buffer_len:
+            self.flush()  # Keep the records in order.
+        ustruct.pack_into(RECORD_HEADER_FORMAT, self._record_header, 0, kind, level, utime.time(), source_id, n)
+        self._append(self._record_header, payload)
+
+    def _jot_record(self, level, source_file, payload):
+        """Write a binary record, defining the source id first if this source hasn't been seen in this file."""
+        source_id = 0
+        if source_file:
+            source_id = self._source_ids.get(source_file, 0)
+            if not source_id:
+                source_id = len(self._source_ids) + 1
+                self._source_ids[source_file] = source_id
+                self._write_record(RECORD_KIND_SOURCE, LEVEL_INFO, source_id, source_file.encode())
+        self._write_record(RECORD_KIND_ENTRY, level, source_id, payload.encode())
+
+    def jot(self, msg, source_file="", line_no="", function_name=""):
+        """Jot an entry. Use source_file==__name__ when you call this function."""
+        # exc_info = sys.exc_info()
+        if self._binary:
+            if line_no:
+                msg = line_no + " - " + (function_name + " - " if function_name else "") + msg
+            elif function_name:
+                msg = function_name + " - " + msg
+            self._jot_record(LEVEL_INFO, source_file, msg)
+            return
+
+        entry = "%d-%02d-%02d %02d:%02d:%02d - " % utime.localtime()[:6]
+        if source_file:
+            entry += source_file + " - "
+        if line_no:
+            entry += line_no + " - "
+        if function_name:
+            entry += function_name + " - "
+        self._write(entry + msg + "\n")
+
+    def jot_exception(self, e):
+        import sys
+        import uio
+        s = uio.StringIO()
+        if self._binary:
+            sys.print_exception(e, s)
+            self._jot_record(LEVEL_EXCEPTION, "", s.getvalue())
+            return
+        s.write("%d-%02d-%02d %02d:%02d:%02d " % utime.localtime()[:6])
+        sys.print_exception(e, s)
+        self._write(s.getvalue())
+
     def print_all_from_jotter(self):
         """Read and print the whole file to stdout."""
+        self.flush()
         try:
             with open(self._filename, 'r') as f:
                 line = f.readline()
@@ -103,27 +253,66 @@ class Jotter:
 
     def print_tail_from_jotter(self, n_lines):
         """Read and print the last n lines to stdout."""
-        try:
-            tail_lines = deque((), n_lines)
-            with open(self._filename, 'r') as f:
-                line = f.readline()
-                while line:
-                    l = line.rstrip("\n")
-                    tail_lines.append(l)
-                    line = f.readline()
+        for l in self.iter_tail(n_lines):
+            print(l)
 
-            for l in tail_lines:
-                print(l)
+    def iter_tail(self, n_lines, block_size=256):
+        """Generator of the last n lines of a text log, oldest first.
+        The file is scanned backwards from the end in block_size chunks to find where the tail starts, so the time
+        and memory taken depend on the length of the tail rather than the size of the log."""
+        self.flush()
+        if n_lines <= 0:
+            return
+        try:
+            f = open(self._filename, 'rb')
         except OSError:
-            pass
+            return
+        try:
+            end = f.seek(0, 2)
+            buf = bytearray(block_size)
+            mv = memoryview(buf)
+            pos = end
+            start = 0
+            newlines = 0
+            while pos > 0:
+                size = block_size if pos >= block_size else pos
+                pos -= size
+                f.seek(pos)
+                f.readinto(mv[:size])
+                i = size - 1
+                while i >= 0:
+                    # The newline at the very end closes the last line rather than starting another.
+                    if buf[i] == 10 and pos + i != end - 1:
+                        newlines += 1
+                        if newlines == n_lines:
+                            start = pos + i + 1
+                            break
+                    i -= 1
+                if newlines == n_lines:
+                    break
+
+            f.seek(start)
+            line = f.readline()
+            while line:
+                yield str(line, 'utf-8').rstrip("\n")
+                line = f.readline()
+        finally:
+            f.close()
 
 
 
-def get_jotter(name="root"):
+def get_jotter(name="root", **kwargs):
+    """Get the named jotter. Keyword arguments are passed on to the Jotter when it is first created."""
     global _jotters
 
     if name in _jotters:
         return _jotters[name]
-    jotter = Jotter(name)
+    jotter = Jotter(name, **kwargs)
     _jotters[name] = jotter
     return jotter
+
+
+def flush_all():
+    """Write out the buffered entries of all jotters. Call before a reset."""
+    for jotter in _jotters.values():
+        jotter.flush()
@@ -31,48 +31,97 @@
 """MicroPython USMART Sensor Application."""
 
 # import network
-import json
 import os
 import pyb
 import machine
 import utime
-from ota_updater.main.ota_updater import OTAUpdater
+import otatrial
+
+# Put back the main directory of any module caught part way through an update before importing from them. This is done
+# by otatrial rather than the ota_updater as the ota_updater may be the module that is missing its main directory.
+try:
+    otatrial.recover_trial()
+except Exception as the_exception:
+    import sys
+    sys.print_exception(the_exception)
+    pass
+
+try:
+    from ota_updater.main.ota_updater import OTAUpdater, HttpClient
+except Exception as the_exception:
+    # Without a working ota_updater the node can never be updated again, so if it has just been updated put back the
+    # previous versions. Once the update has been confirmed it is left alone, so that something passing such as a
+    # MemoryError from a fragmented heap doesn't downgrade it for good.
+    import sys
+    sys.print_exception(the_exception)
+    trial = otatrial.load_trial()
+    if trial and 'ota_updater' in trial['modules'] and otatrial.rollback_trial():
+        machine.reset()
+    raise
+
+# The ota_updater module is updated from its own repo, so the installed release may not have everything this copy of it
+# has. The newer features are checked for with hasattr() before they are used, falling back to the original calls, so
+# that a node with an older release of it still boots and can still be updated over the air.
+
 import jotter
+import phasetimer
+import configuration
+import hibernation
+import battery
 
 # Add your own ota updateable application modules to this list.
 ota_modules = ['mainloop', 'ota_updater', 'pybd_expansion', 'sensor_payload', 'uac_localisation', 'uac_modem',
                'uac_network']
 
+# Number of modules to check for updates at the same time.
+OTA_CONCURRENCY = 3
 
-def load_wifi_config():
-    """Load Wifi Configuration from JSON file."""
-    wifi_config = None
-    config_filename = 'config/wifi_cfg.json'
-    try:
-        with open(config_filename) as json_config_file:
-            wifi_config = json.load(json_config_file)
-    except Exception:
-        pass
+# Update bundle installed at boot without the wifi, see install_bundle_if_available().
+OTA_BUNDLE_DIR = '/sd/ota'
 
-    return wifi_config
+# An update is rolled back after failing this many boots in a row.
+OTA_TRIAL_BOOTS = 3
+# An update is trusted once the mainloop has run this long, or has gone into deepsleep.
+OTA_TRIAL_CONFIRM_MS = 600000
 
+# Measurements made during boot, passed on to the mainloop.
+boot_metrics = {}
 
-def load_ota_config(module_name):
-    """Load OTA Configuration from JSON file."""
-    ota_config = None
-    config_filename = 'config/' + module_name + '_gitrepo_cfg.json'
-    try:
-        with open(config_filename) as json_config_file:
-            ota_config = json.load(json_config_file)
-    except Exception:
-        pass
+# Startup window defaults, can be set in config/startup_cfg.json
+STARTUP_WINDOW_MS = 5000  # With no USB host connected.
+STARTUP_USB_WINDOW_MS = 30000  # Once a USB host is connected.
 
-    return ota_config
+
+def load_wifi_config():
+    """Load Wifi Configuration."""
+    return configuration.get_config()['wifi']
+
+
+def load_ota_config(module_name):
+    """Load OTA Configuration."""
+    return configuration.get_module_config(module_name)
 
 
 def get_installed_module_versions():
     """Get the version of each of the installed modules.
+    Read from the installed manifest, falling back to scanning the module directories if it is missing or stale.
     Returns a dictionary of module to version pairs"""
+    scan_start = utime.ticks_ms()
+    mod_version_dictionary = None
+    if hasattr(OTAUpdater, 'load_installed_manifest'):
+        mod_version_dictionary = OTAUpdater.load_installed_manifest()
+    else:
+        # An ota_updater without the manifest doesn't keep it up to date as it applies updates.
+        otatrial.forget_installed_versions()
+    if mod_version_dictionary is not None:
+        for ota_module in ota_modules:
+            if ota_module and ota_module not in mod_version_dictionary:
+                mod_version_dictionary = None  # Stale, a module has been added since it was written.
+                break
+    if mod_version_dictionary is not None:
+        print("Installed versions from manifest in " + str(utime.ticks_diff(utime.ticks_ms(), scan_start)) + " ms")
+        return mod_version_dictionary
+
     mod_version_dictionary = {}
 
     try:
@@ -81,20 +130,94 @@ def get_installed_module_versions():
             if ota_module:
                 print("ota_module=" + ota_module)
                 ota_cfg = load_ota_config(ota_module)
+                v = None
                 if ota_cfg:
                     o = OTAUpdater(ota_cfg['gitrepo']['url'], ota_module)
                     v = o.get_current_version()
-                    mod_version_dictionary[ota_module] = v
+                mod_version_dictionary[ota_module] = v
 
         pass
     except Exception:
         pass
 
+    print("Installed versions from scan in " + str(utime.ticks_diff(utime.ticks_ms(), scan_start)) + " ms")
+
+    # Save the manifest so the next boot doesn't need to scan.
+    try:
+        if hasattr(OTAUpdater, 'save_installed_manifest'):
+            OTAUpdater.save_installed_manifest(mod_version_dictionary)
+    except Exception as the_exception:
+        jotter.get_jotter().jot_exception(the_exception)
+
     return mod_version_dictionary
 
 
+def update_modules(wdt, updaters, latest_versions=None):
+    """Check each module for updates, download if available, then overwrite main/. One module after another."""
+    for i in range(len(updaters)):
+        o = updaters[i]
+        # Feed the watchdog
+        wdt.feed()
+
+        print("ota_module=" + o.get_module_and_path(''))
+        try:
+            # download_updates_if_available - Checks version numbers and downloads into next/
+            if latest_versions and latest_versions[i]:
+                o.download_updates_if_available(latest_versions[i])
+            else:
+                o.download_updates_if_available()
+            # apply_pending_updates_if_available - Moves next/ into main/
+            o.apply_pending_updates_if_available()
+        except Exception as the_exception:
+            import sys
+            sys.print_exception(the_exception)
+
+
+async def feed_watchdog_async(wdt, period_ms=5000):
+    """Background task to keep the watchdog fed while the update tasks run."""
+    import uasyncio
+    while True:
+        wdt.feed()
+        await uasyncio.sleep_ms(period_ms)
+
+
+async def update_modules_async(wdt, http_client, updaters, concurrency):
+    """Check all the modules for updates with up to concurrency checks running at once, then download and apply.
+    Each check in flight has its own pooled connection, so the round trips overlap and the watchdog is fed while they
+    wait on the network, at a cost of up to concurrency TLS handshakes. The downloads themselves run one module at a
+    time as they share the one radio and write to the same flash."""
+    import uasyncio
+    feeder = uasyncio.create_task(feed_watchdog_async(wdt))
+    try:
+        latest_versions = [None] * len(updaters)
+        next_index = [0]
+
+        async def check_worker():
+            while next_index[0] < len(updaters):
+                i = next_index[0]
+                next_index[0] += 1
+                try:
+                    latest_versions[i] = await updaters[i].get_latest_version_async()
+                except Exception as the_exception:
+                    # Leave it as None and the blocking check will be tried again in update_modules()
+                    import sys
+                    sys.print_exception(the_exception)
+
+        await uasyncio.gather(*[check_worker() for _ in range(concurrency)])
+        await http_client.close_async()
+
+        # Yield to the feeder between modules.
+        for i in range(len(updaters)):
+            update_modules(wdt, updaters[i:i + 1], latest_versions[i:i + 1])
+            await uasyncio.sleep_ms(0)
+    finally:
+        feeder.cancel()
+
+
 def download_and_install_updates_if_available():
     """Connects to WiFi and checks for all modules for updates. This function will always cause a machine reset. """
+    http_client = None
+    bytes_saved = 0
     try:
         # Need to start the WDT during this. And to finish with the reset.
         import machine
@@ -126,7 +249,12 @@ def download_and_install_updates_if_available():
         wdt.feed()
 
         # Open Wifi
-        if not OTAUpdater.using_network(wifi_cfg['wifi']['ssid'], wifi_cfg['wifi']['password']):
+        if hasattr(OTAUpdater, 'load_wifi_cache'):
+            connected = OTAUpdater.using_network(wifi_cfg['wifi']['ssid'], wifi_cfg['wifi']['password'],
+                                                 fast_reconnect=wifi_cfg['wifi'].get('fast_reconnect', True))
+        else:
+            connected = OTAUpdater.using_network(wifi_cfg['wifi']['ssid'], wifi_cfg['wifi']['password'])
+        if not connected:
             # Failed to connect
             print("Unable to connect to wifi")
             raise Exception("Unable to connect to wifi")
@@ -134,23 +262,37 @@ def download_and_install_updates_if_available():
         # Feed the watchdog
         wdt.feed()
 
-        # Startup Load Configuration For Each Module and check for updates, download if available, then overwrite main/
-        for ota_module in ota_modules:
-            # Feed the watchdog
-            wdt.feed()
+        # One client for the whole session so connections to GitHub are reused between modules.
+        if hasattr(HttpClient, 'release'):
+            http_client = HttpClient()
 
-            print("ota_module=" + ota_module)
+        # Startup Load Configuration For Each Module
+        github_pat = None
+        if wifi_cfg.get('github') and wifi_cfg['github'].get('pat'):
+            github_pat = wifi_cfg['github']['pat']
+
+        updaters = []
+        for ota_module in ota_modules:
             ota_cfg = load_ota_config(ota_module)
             if ota_cfg:
-                github_pat = None
-                if wifi_cfg.get('github') and wifi_cfg['github'].get('pat'):
-                    github_pat = wifi_cfg['github']['pat']
-
-                o = OTAUpdater(ota_cfg['gitrepo']['url'], ota_module, github_pat=github_pat)
-                # download_updates_if_available - Checks version numbers and downloads into next/
-                o.download_updates_if_available()
-                # apply_pending_updates_if_available - Moves next/ into main/
-                o.apply_pending_updates_if_available()
+                options = {}
+                if http_client:
+                    options['http_client'] = http_client
+                if ota_cfg['gitrepo'].get('asset') and hasattr(OTAUpdater, 'download_release_assets'):
+                    options['release_asset'] = ota_cfg['gitrepo']['asset']
+                updaters.append(OTAUpdater(ota_cfg['gitrepo']['url'], ota_module, github_pat=github_pat, **options))
+
+        # Check for updates, download if available, then overwrite main/
+        session_start = utime.ticks_ms()
+        if http_client and hasattr(HttpClient, 'async_supported') and HttpClient.async_supported():
+            import uasyncio
+            uasyncio.run(update_modules_async(wdt, http_client, updaters, OTA_CONCURRENCY))
+        else:
+            update_modules(wdt, updaters)
+        print('Update session took ' + str(utime.ticks_diff(utime.ticks_ms(), session_start)) + ' ms')
+
+        for o in updaters:
+            bytes_saved += getattr(o, 'bytes_saved', 0)
 
     except Exception as the_exception:
         import sys
@@ -158,48 +300,148 @@ def download_and_install_updates_if_available():
         pass
 
     finally:
+        if http_client:
+            http_client.close()
+            print('Connections opened: ' + str(http_client.connections_opened)
+                  + ' Handshakes saved: ' + str(http_client.handshakes_saved)
+                  + ' Bytes saved: ' + str(bytes_saved))
+
         utime.sleep_ms(2000) # pause to let print statements complete
+        jotter.flush_all()
         # Now need to reboot to make use of the updated modules
         machine.reset()
 
 
-def low_power_pins(disable_3v3=False, disable_leds=False):
-    # from https://github.com/micropython/micropython/issues/4686
-    pins = [
-        # user IO pins
-        'A0', 'A1', 'A2', 'A3', 'A4', 'A5', 'A6', 'A7', 'A8', 'A9', 'A10', 'A11', 'A12', 'A13', 'A14', 'A15',
-        'B0', 'B1', 'B3', 'B4', 'B5', 'B7', 'B8', 'B9', 'B10', 'B11', 'B12', 'B13',
-        'C0', 'C1', 'C2', 'C3', 'C4', 'C5', 'C6',
-        'D0', 'D3', 'D8', 'D9',
-        'E0', 'E1', 'E12', 'E14', 'E15',
-        'F1', 'F6', 'F7', 'F8', 'F9', 'F10', 'F11', 'F13', 'F14', 'F15',
-        'H2', 'H3', 'H5', 'H6', 'H7', 'H8',
-        'I0', 'I1',
-
-        # internal pins
-        'D1', 'D14', 'D15',
-        'F0', 'F12',
-        'G0', 'G1', 'G2', 'G3', 'G4', 'G5', #'G6',
-        'H4', 'H9', 'H10', 'H11', 'H12', 'H13', 'H14', 'H15',
-        'I2', 'I3',
-    ]
-    pins_led = ['F3', 'F4', 'F5',]
-    pins_sdmmc = ['D6', 'D7', 'G9', 'G10', 'G11', 'G12']
-    pins_wlan = ['D2', 'D4', 'I7', 'I8', 'I9', 'I11']
-    pins_bt = ['D5', 'D10', 'E3', 'E4', 'E5', 'E6', 'G8', 'G13', 'G14', 'G15', 'I4', 'I5', 'I6', 'I10']
-    pins_qspi1 = ['B2', 'B6', 'D11', 'D12', 'D13', 'E2']
-    pins_qspi2 = ['E7', 'E8', 'E9', 'E10', 'E11', 'E13']
-    for p in pins:
-        pyb.Pin(p, pyb.Pin.IN, pyb.Pin.PULL_DOWN)
-    if disable_3v3:
-       pyb.Pin('EN_3V3', pyb.Pin.IN, None)
-    if disable_leds:
-        for p in pins_led:
-            pyb.Pin(p, pyb.Pin.IN, pyb.Pin.PULL_UP)
+def install_bundle_if_available():
+    """Install the module updates from a bundle on the SD card, made on the host with scripts/makebundle.py.
+    This needs no wifi or GitHub, so a node can be updated in seconds by swapping the card and without powering the
+    radio. Each bundle is only installed once, so an update that is rolled back isn't tried again until a new bundle
+    is put on the card. Resets the machine if any module was updated."""
+    if not hasattr(OTAUpdater, 'load_bundle_index'):
+        return  # The installed ota_updater can't install bundles.
+    bundle = OTAUpdater.load_bundle_index(OTA_BUNDLE_DIR)
+    if not bundle or bundle['digest'] == OTAUpdater.load_installed_bundle():
+        return
+
+    session_start = utime.ticks_ms()
+    updated = []
+    bytes_copied = 0
+    for ota_module in ota_modules:
+        print("ota_module=" + ota_module)
+        o = OTAUpdater('', ota_module)
+        try:
+            if o.copy_updates_from_bundle_if_available(bundle['modules'], OTA_BUNDLE_DIR):
+                o.apply_pending_updates_if_available()
+                updated.append(ota_module)
+        except Exception as the_exception:
+            jotter.get_jotter().jot_exception(the_exception)
+            import sys
+            sys.print_exception(the_exception)
+        bytes_copied += o.bytes_copied
+
+    OTAUpdater.save_installed_bundle(bundle['digest'])
+    session_ms = utime.ticks_diff(utime.ticks_ms(), session_start)
+    jotter.get_jotter().jot("Installed bundle updating " + (", ".join(updated) or "nothing") + ": "
+                            + str(bytes_copied) + " bytes in " + str(session_ms) + " ms", source_file=__name__)
+
+    if updated:
+        jotter.flush_all()
+        # Now need to reboot to make use of the updated modules
+        import machine
+        machine.reset()
+
+
+def check_ota_trial():
+    """Count this boot against the modules on trial after an update. Once OTA_TRIAL_BOOTS boots have gone by without
+    the update being confirmed the previous versions are put back and the device reset.
+    Returns True if an update is on trial."""
+    trial = otatrial.load_trial()
+    if not trial:
+        return False
+
+    if machine.reset_cause() == machine.DEEPSLEEP_RESET:
+        # The mainloop went into deepsleep on purpose last time round.
+        confirm_ota_trial()
+        return False
+
+    if trial.get('boots', 0) >= OTA_TRIAL_BOOTS:
+        jotter.get_jotter().jot("Rolling back " + ", ".join(trial['modules']) + " after "
+                                + str(trial['boots']) + " failed boots", source_file=__name__)
+        otatrial.rollback_trial()
+        jotter.flush_all()
+        machine.reset()
+
+    trial['boots'] = trial.get('boots', 0) + 1
+    otatrial.save_trial(trial)
+
+    # The soft timer callback is scheduled to run between bytecodes so it is safe to write the file from it.
+    machine.Timer(-1, mode=machine.Timer.ONE_SHOT, period=OTA_TRIAL_CONFIRM_MS, callback=confirm_ota_trial)
+    return True
+
+
+def confirm_ota_trial(timer=None):
+    """The update is working, stop counting boots and keep it."""
+    trial = otatrial.load_trial()
+    if trial:
+        jotter.get_jotter().jot("Confirmed update of " + ", ".join(trial['modules']), source_file=__name__)
+        otatrial.save_trial(None)
+
+
+def load_startup_config():
+    """Load Startup Configuration."""
+    return configuration.get_config()['startup']
+
+
+def usb_powered():
+    """True if there is power on the USB, or if the board can't tell. Read without reconfiguring the pin, which the
+    USB driver may be using to sense VBUS."""
+    try:
+        return bool(pyb.Pin('USB_VBUS').value())
+    except Exception:
+        return True
+
+
+def startup_window():
+    """Delay at the start to connect via REPL and kill the program before it fires up the WDT.
+    Skipped after a watchdog or deepsleep reset as nobody is there to connect. Otherwise waits for the short window,
+    stretching to the USB window if a host is connected over USB. The wait is spent in lightsleep only while the USB
+    has no power, as the USB isn't serviced in lightsleep and a host plugged in might never finish enumerating."""
+    reset_cause = machine.reset_cause()
+    if reset_cause == machine.WDT_RESET or reset_cause == machine.DEEPSLEEP_RESET:
+        return
+
+    window_ms = STARTUP_WINDOW_MS
+    usb_window_ms = STARTUP_USB_WINDOW_MS
+    startup_cfg = load_startup_config()
+    if startup_cfg and startup_cfg.get('startup'):
+        window_ms = startup_cfg['startup'].get('window_ms', window_ms)
+        usb_window_ms = startup_cfg['startup'].get('usb_window_ms', usb_window_ms)
+
+    # Red and Green LEDs on during the startup wait period
+    pyb.LED(1).on()
+    pyb.LED(2).on()
+
+    vcp = pyb.USB_VCP()
+    timeout_start = utime.ticks_ms()
+    while utime.ticks_diff(utime.ticks_ms(), timeout_start) < window_ms:
+        if vcp.isconnected():
+            # Stay awake so USB is serviced and Ctrl-C reaches the REPL.
+            window_ms = usb_window_ms
+            utime.sleep_ms(100)
+        elif usb_powered():
+            # Stay awake while a host enumerates the USB and opens the serial port.
+            utime.sleep_ms(100)
+        else:
+            machine.lightsleep(100)
+
+    # Red and Green LEDs off after the startup wait period
+    pyb.LED(1).off()
+    pyb.LED(2).off()
+
 
 def boot():
-    # Check battery voltage and if below a set value power off all peripherals and permanently enter deepsleep.
-    # Letting the battery run down and repeat brownout/POR damages the PYBD.
+    # Check battery voltage and if below a set value power off all peripherals and hibernate in deepsleep, waking
+    # periodically to check if it has recovered. Letting the battery run down and repeat brownout/POR damages the PYBD.
 
     # Cycle the NM3 power supply on the powermodule
     try:
@@ -209,32 +451,39 @@ def boot():
         powermodule = PowerModule()
 
 
-        # 2 second delay at the start to allow battery voltage at the ADC to stabilise.
-        timeout_start = utime.time()
-        while utime.time() < timeout_start + 2:
-            utime.sleep_ms(100)
-
-
-        vbatt_volts = powermodule.get_vbatt_reading()
-
-        if vbatt_volts < 3.6:
-            # Turn off the USB
-            pyb.usb_mode(None)
+        # Sample until the battery voltage at the ADC has stabilised, to be sure which side of the threshold it is.
+        vbatt_start = utime.ticks_ms()
+        vbatt_volts, vbatt_samples = battery.measure_vbatt(powermodule)
+        boot_metrics['vbatt'] = vbatt_volts
+        boot_metrics['vbatt_samples'] = vbatt_samples
+        boot_metrics['vbatt_ms'] = utime.ticks_diff(utime.ticks_ms(), vbatt_start)
 
-            low_power_pins(disable_3v3=True, disable_leds=True)
+        # The wake-ups from hibernation are checked in boot.py by battery.recheck_hibernation(), so only get this far
+        # once the battery has recovered.
+        if vbatt_volts < battery.VBATT_CUTOFF:
+            jotter.get_jotter().jot("Hibernating with vbatt=" + str(vbatt_volts), source_file=__name__)
+            jotter.flush_all()
+            battery.hibernate(powermodule)
 
-            powermodule.disable_nm3() # Needs to be driven low in order to pull-down the external resistor.
-
-            while 1:
-                machine.lightsleep() # Enter lightsleep
-                utime.sleep_ms(100)
 
+    except Exception as the_exception:
+        import sys
+        sys.print_exception(the_exception)
+        pass
 
+    # Report the hibernation we have just come out of.
+    try:
+        wakeups = hibernation.take_resumed_wakeups()
+        if wakeups is not None:
+            jotter.get_jotter().jot("Resumed from hibernation after " + str(wakeups) + " wake-ups",
+                                    source_file=__name__)
     except Exception as the_exception:
         import sys
         sys.print_exception(the_exception)
         pass
 
+    phasetimer.get_phase_timer().mark('battery_check')
+
 
     # Check reason for reset - only update if power on reset.
     #try:
@@ -253,6 +502,16 @@ def boot():
     # everytime active(True) is called (on powerup of the wifi SoC) this may have detrimental effect.
     # See open issue: https://github.com/micropython/micropython/issues/7738
 
+    # Update from a bundle on the SD card
+    try:
+        install_bundle_if_available()
+    except Exception as the_exception:
+        jotter.get_jotter().jot_exception(the_exception)
+
+        import sys
+        sys.print_exception(the_exception)
+        pass
+
     # Manual OTA request
     try:
         # Check for the flag file .USOTA
@@ -270,6 +529,8 @@ def boot():
         pass
         # Log to file
 
+    phasetimer.get_phase_timer().mark('ota_check')
+
     # Start the main application
     # try:
     start()
@@ -283,18 +544,7 @@ def start():
     # Run the application from the MainLoop.
     try:
         # jotter.get_jotter().jot("start()", source_file=__name__)
-        # Red and Green LEDs on during the startup wait period
-        pyb.LED(1).on()
-        pyb.LED(2).on()
-
-        # 30 second delay at the start to connect via REPL and kill the program before it fires up the WDT.
-        timeout_start = utime.time()
-        while utime.time() < timeout_start + 30:
-            utime.sleep_ms(100)
-
-        # Red and Green LEDs off after the startup wait period
-        pyb.LED(1).off()
-        pyb.LED(2).off()
+        startup_window()
 
     except Exception as the_exception:
         jotter.get_jotter().jot_exception(the_exception)
@@ -304,6 +554,8 @@ def start():
         pass
         # Log to file
 
+    phasetimer.get_phase_timer().mark('startup_window')
+
     # Get installed modules and versions
     installed_modules = None
     try:
@@ -320,10 +572,31 @@ def start():
         pass
         # Log to file
 
+    phasetimer.get_phase_timer().mark('version_scan')
+
+    # Count this boot if an update is on trial, rolling it back if it has failed too many times.
+    on_trial = False
+    try:
+        on_trial = check_ota_trial()
+    except Exception as the_exception:
+        jotter.get_jotter().jot_exception(the_exception)
+
+        import sys
+        sys.print_exception(the_exception)
+        pass
+
     # Now run the mainloop
     try:
         import mainloop.main.mainloop as ml
-        env_variables = {"installedModules": installed_modules}
+        phase_timer = phasetimer.get_phase_timer()
+        phase_timer.mark('mainloop_import')
+        summary = phase_timer.summary()
+        if 'vbatt' in boot_metrics:
+            summary += " vbatt=%.3f samples=%d vbatt_ms=%d" % (boot_metrics['vbatt'], boot_metrics['vbatt_samples'],
+                                                              boot_metrics['vbatt_ms'])
+        jotter.get_jotter().jot(summary, source_file=__name__)
+        env_variables = {"installedModules": installed_modules, "bootPhases": phase_timer.get_durations(),
+                         "bootMetrics": boot_metrics}
         ml.set_environment_variables(env_variables)
         jotter.get_jotter().jot("start()::run_mainloop()", source_file=__name__)
         ml.run_mainloop()
@@ -335,6 +608,11 @@ def start():
         pass
         # Log to file
 
+    jotter.flush_all()
+
+    if on_trial and otatrial.load_trial():
+        # The updated mainloop has failed so reset to count another boot towards the rollback.
+        machine.reset()
     pass
 
 
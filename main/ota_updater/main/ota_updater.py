@@ -37,14 +37,43 @@ import os
 import gc
 import utime
 
+# Architecture names used by mpy-cross -march, indexed by the architecture in sys.implementation._mpy >> 10.
+MPY_ARCH_NAMES = ['', 'x86', 'x64', 'armv6', 'armv6m', 'armv7m', 'armv7em', 'armv7emsp', 'armv7emdp', 'xtensa',
+                  'xtensawin', 'rv32imc']
+
+# Versions of all the installed modules, kept up to date as updates are applied so they can be read in one go at boot.
+INSTALLED_MANIFEST = 'installed_manifest.json'
+
+# Access point, channel and IP configuration of the last wifi connection, see OTAUpdater.using_network().
+WIFI_CACHE = 'wifi_cache.json'
+WIFI_CONNECT_TIMEOUT_MS = 20000
+WIFI_FAST_TIMEOUT_MS = 3000
+
+# Index of an update bundle on the SD card made with scripts/makebundle.py, and the sha1 of the last bundle installed.
+BUNDLE_INDEX = 'bundle.json'
+INSTALLED_BUNDLE = 'ota_bundle.txt'
+
 class OTAUpdater:
     """OTA Updater for a given module."""
 
-    def __init__(self, github_repo, module='', main_dir='main', github_pat=None):
+    def __init__(self, github_repo, module='', main_dir='main', github_pat=None, chunk_size=512, http_client=None,
+                 release_asset=None):
         """Initialise with url to the github repo, the module, and the main directory within the module
-        plus optional github personal access token."""
-        self._http_client = HttpClient()
+        plus optional github personal access token. chunk_size sets the download buffer in bytes.
+        Pass a shared http_client to reuse its pooled connections across several modules.
+        If release_asset names an uncompressed tar attached to the release then the update is unpacked from that
+        single download rather than walking the repo contents file by file. A precompiled variant of the asset
+        matching this firmware's .mpy version and architecture is preferred if the release has one, see
+        get_mpy_asset_name()."""
+        self._http_client = http_client if http_client else HttpClient()
+        self._release_asset = release_asset
+        self._latest_assets = []  # [name, url] of the usable release assets, most preferred first.
+        self._buffer = bytearray(chunk_size)  # Preallocated so downloads don't grow the heap with file size.
         self._github_repo = github_repo.rstrip('/').replace('https://github.com', 'https://api.github.com/repos')
+        self._github_raw = github_repo.rstrip('/').replace('https://github.com', 'https://raw.githubusercontent.com')
+        self.bytes_downloaded = 0
+        self.bytes_saved = 0  # Bytes copied from the installed version instead of being downloaded again.
+        self.bytes_copied = 0  # Bytes copied from an update bundle.
         self._main_dir = main_dir
         self._module = module.rstrip('/')
         self._github_pat = github_pat
@@ -53,55 +82,149 @@ class OTAUpdater:
         return self
 
     @staticmethod
-    def using_network(ssid, password, antenna=0):
-        """Connects to the wifi with the given ssid and password. antenna can be 0=chip, 1=external."""
+    def using_network(ssid, password, antenna=0, timeout_ms=WIFI_CONNECT_TIMEOUT_MS, fast_reconnect=True):
+        """Connects to the wifi with the given ssid and password. antenna can be 0=chip, 1=external.
+        With fast_reconnect the access point, channel and IP configuration of the last connection are kept in
+        WIFI_CACHE, and the next connection goes straight to that access point with the same static IP configuration
+        rather than scanning and waiting on DHCP. If that fails within WIFI_FAST_TIMEOUT_MS it falls back to a scan
+        and DHCP. Gives up after timeout_ms. Returns True if connected."""
         import network
         sta_if = network.WLAN(network.STA_IF)
-        if not sta_if.isconnected():
-            print('connecting to network...')
-            print('SSID: ' + ssid + ' password:' + password)
+        if sta_if.isconnected():
+            return True
 
-            #print('setting active')
-            sta_if.active(True)
-            #utime.sleep_ms(10000) # yield for network processes
+        start = utime.ticks_ms()
+        print('connecting to network...')
+        print('SSID: ' + ssid)
+        sta_if.active(True)
+        sta_if.config(antenna=antenna)  # select antenna, 0=chip, 1=external
 
-            #print('setting antenna')
-            sta_if.config(antenna=antenna)  # select antenna, 0=chip, 1=external
-            #utime.sleep_ms(1000) # yield for network processes
+        cache = OTAUpdater.load_wifi_cache(ssid) if fast_reconnect else None
+        connected = False
+        best = None
+        if cache:
+            try:
+                import ubinascii
+                # The fast path has WIFI_FAST_TIMEOUT_MS from here, so bringing the interface up doesn't count.
+                fast_start = utime.ticks_ms()
+                sta_if.ifconfig(tuple(cache['ifconfig']))
+                sta_if.connect(ssid, password, bssid=ubinascii.unhexlify(cache['bssid']), channel=cache['channel'])
+                connected = OTAUpdater.wait_for_connection(
+                    sta_if, fast_start, min(WIFI_FAST_TIMEOUT_MS, timeout_ms - utime.ticks_diff(fast_start, start)))
+                if connected:
+                    print('Connected to the cached access point')
+            except Exception as the_exception:
+                import sys
+                sys.print_exception(the_exception)
+            if not connected:
+                print('Cached access point not found, scanning...')
+                # Power cycle the interface to go back to DHCP. ifconfig('dhcp') would wait for a lease, which can't
+                # come before the interface is associated, and raise after about 10 s.
+                try:
+                    sta_if.disconnect()
+                    sta_if.active(False)
+                    sta_if.active(True)
+                    sta_if.config(antenna=antenna)
+                except OSError as the_exception:
+                    import sys
+                    sys.print_exception(the_exception)
 
-            #print('connecting')
-            sta_if.connect(ssid, password)
-            utime.sleep_ms(100) # yield for network processes
+        if not connected:
+            if fast_reconnect:
+                # Scan for the strongest access point with the ssid, to join it directly and remember it for next time.
+                # (ssid, bssid, channel, RSSI, security, hidden)
+                try:
+                    for ap in sta_if.scan():
+                        if ap[0] == ssid.encode() and (best is None or ap[3] > best[3]):
+                            best = ap
+                except OSError:
+                    pass
+            if best:
+                sta_if.connect(ssid, password, bssid=best[1], channel=best[2])
+            else:
+                sta_if.connect(ssid, password)
+            connected = OTAUpdater.wait_for_connection(sta_if, start, timeout_ms)
 
-            #print('checking if is connected')
-            while not sta_if.isconnected():
+        elapsed = utime.ticks_diff(utime.ticks_ms(), start)
+        if not connected:
+            print('Unable to connect after ' + str(elapsed) + ' ms')
+            return False
 
-                utime.sleep_ms(100) # yield for network processes
+        print('Connected in ' + str(elapsed) + ' ms')
+        print('network config:', sta_if.ifconfig())
+        if fast_reconnect and best:
+            try:
+                import ubinascii
+                OTAUpdater.save_wifi_cache({'ssid': ssid, 'bssid': str(ubinascii.hexlify(best[1]), 'ascii'),
+                                            'channel': best[2], 'ifconfig': list(sta_if.ifconfig())}, cache)
+            except OSError:
+                pass
+        return True
 
-                # Check the status
-                # print('getting status')
-                status = sta_if.status()
-                # Constants aren't implemented for PYBD as of MicroPython v1.13.
-                # From: https://github.com/micropython/micropython/issues/4682
-                # 'So "is-connecting" is defined as s.status() in (1, 2) and "is-connected" is defined as s.status() == 3.'
-                #
-                if status <= 0:
-                    # Error States?
-                    return False
-                #if ((status == network.WLAN.STAT_IDLE) or (status == network.WLAN.STAT_WRONG_PASSWORD)
-                #        or (status == network.WLAN.STAT_NO_AP_FOUND) or (status == network.WLAN.STAT_CONNECT_FAIL)):
-                    # Problems so return
-                #    return False
-                #print('checking if is connected')
+    @staticmethod
+    def wait_for_connection(sta_if, start, timeout_ms):
+        """Wait until connected or timeout_ms after start. Returns True if connected."""
+        while not sta_if.isconnected():
+            if utime.ticks_diff(utime.ticks_ms(), start) >= timeout_ms:
+                return False
 
+            utime.sleep_ms(100) # yield for network processes
 
-        print('network config:', sta_if.ifconfig())
+            # Check the status
+            status = sta_if.status()
+            # Constants aren't implemented for PYBD as of MicroPython v1.13.
+            # From: https://github.com/micropython/micropython/issues/4682
+            # 'So "is-connecting" is defined as s.status() in (1, 2) and "is-connected" is defined as s.status() == 3.'
+            #
+            if status <= 0:
+                # Error States?
+                return False
         return True
 
-    def download_updates_if_available(self):
-        """Downloads available updates and leaves them in the 'next' directory alongside the 'main' directory."""
+    @staticmethod
+    def load_wifi_cache(ssid):
+        """Load the details of the last connection to the ssid. Returns None if there aren't any."""
+        try:
+            import ujson
+            with open(WIFI_CACHE) as f:
+                cache = ujson.load(f)
+            if cache.get('ssid') == ssid:
+                return cache
+        except (OSError, ValueError):
+            pass
+        return None
+
+    @staticmethod
+    def save_wifi_cache(cache, previous=None):
+        """Save the details of the connection, unless they are the same as the previous ones."""
+        if cache == previous:
+            return
+        import ujson
+        with open(WIFI_CACHE, 'w') as f:
+            ujson.dump(cache, f)
+
+    def download_updates_if_available(self, latest_version=None):
+        """Downloads available updates and leaves them in the 'next' directory alongside the 'main' directory.
+        latest_version can be passed in if it has already been fetched with get_latest_version_async."""
+        if not latest_version:
+            latest_version = self.get_latest_version()
+
+        if self.is_newer_version(latest_version):
+            print('Updating...')
+            # Create the next directory and download the source files.
+            self.make_next_directory()
+            if not self.download_release_assets():
+                if not self.download_changed_files(latest_version):
+                    self.download_all_files(self._github_repo + '/contents/' + self._main_dir, latest_version)
+
+            # Last step is to write the .version file only if we have completed the download
+            self.write_next_version(latest_version)
+            return True
+        return False
+
+    def is_newer_version(self, latest_version):
+        """Compare the latest version with the installed version. Returns True if the latest should be installed."""
         current_version = self.get_version(self.get_module_and_path(self._main_dir))
-        latest_version = self.get_latest_version()
 
         print('Checking version... ')
         print('\tCurrent version: ', current_version)
@@ -109,37 +232,141 @@ class OTAUpdater:
 
         if not latest_version:
             return False
+        return (not current_version) or (latest_version > current_version)
 
-        if (not current_version) or (latest_version > current_version):
-            print('Updating...')
-            if not self.path_exists(self._module):
-                os.mkdir(self._module)
+    def make_next_directory(self):
+        """Create an empty 'next' directory to stage an update in."""
+        if not self.path_exists(self._module):
+            os.mkdir(self._module)
 
-            # Check if there's a botched download already. If next directory already exists remove it and tree.
-            if self.path_exists(self.get_module_and_path('next')):
-                self.rmtree(self.get_module_and_path('next'))  # Remove the 'next' directory and contents.
+        # Check if there's a botched download already. If next directory already exists remove it and tree.
+        if self.path_exists(self.get_module_and_path('next')):
+            self.rmtree(self.get_module_and_path('next'))  # Remove the 'next' directory and contents.
+        os.mkdir(self.get_module_and_path('next'))
 
-            # Create the next directory and download the source files.
-            os.mkdir(self.get_module_and_path('next'))
-            self.download_all_files(self._github_repo + '/contents/' + self._main_dir, latest_version)
+    def write_next_version(self, version):
+        """Write the .version file that marks the update staged in the 'next' directory as complete."""
+        with open(self.get_module_and_path('next/.version'), 'w') as versionfile:
+            versionfile.write(version)
+            versionfile.close()
 
-            # Last step is to write the .version file only if we have completed the download
-            with open(self.get_module_and_path('next/.version'), 'w') as versionfile:
-                versionfile.write(latest_version)
-                versionfile.close()
+    def copy_updates_from_bundle_if_available(self, bundle, bundle_dir):
+        """Copies an update of the module from the bundle on the SD card into the 'next' directory, as
+        download_updates_if_available() does from GitHub, if it is newer than the installed version.
+        bundle is the 'modules' of the bundle index, module to {'version', 'path', 'sha256'}. The path below bundle_dir
+        is either a tar of the 'main' directory, checked against the sha256 if given, or a copy of the 'main'
+        directory whose files are checked against its manifest. Raises ValueError on a mismatch, with nothing staged.
+        Returns True if an update was staged."""
+        entry = bundle.get(self._module)
+        if not entry or not self.is_newer_version(entry.get('version')):
+            return False
 
-            return True
-        return False
+        print('Updating from bundle...')
+        self.make_next_directory()
+        next_dir = self.get_module_and_path('next')
+        path = bundle_dir + '/' + entry['path']
+        try:
+            if entry['path'].endswith('.tar'):
+                self.copy_bundle_tar(path, next_dir, entry.get('sha256'))
+            else:
+                self.copy_bundle_directory(path, next_dir, self.load_manifest(path))
+            self.validate_mpy_files(next_dir)
+        except (OSError, ValueError):
+            self.rmtree(next_dir)
+            raise
+
+        self.write_next_version(entry['version'])
+        return True
+
+    def copy_bundle_tar(self, path, directory, sha256=None):
+        """Unpack the 'main' directory of the tar at path into directory. The tar is hashed as it is read if the
+        sha256 hex digest is given."""
+        print('\tUnpacking: ', path)
+        with open(path, 'rb') as f:
+            instream = f
+            if sha256:
+                import uhashlib
+                instream = HashingReader(f, uhashlib.sha256())
+            self.extract_tar(instream, directory)
+            self.bytes_copied += os.stat(path)[6]
+            if instream is not f:
+                self.copy_stream(instream, None)  # Hash the padding after the end of archive marker.
+                if self.hexdigest(instream.hasher) != sha256:
+                    raise ValueError('Hash mismatch: ' + path)
+
+    def copy_bundle_directory(self, source, directory, manifest, prefix=''):
+        """Copy the tree below source into directory. Files in the manifest of path to [sha, size] have their git blob
+        sha checked as they are copied."""
+        import uhashlib
+        for entry in os.ilistdir(source):
+            source_path = source + '/' + entry[0]
+            path = directory + '/' + entry[0]
+            if entry[1] == 0x4000:
+                os.mkdir(path)
+                self.copy_bundle_directory(source_path, path, manifest, prefix + entry[0] + '/')
+                continue
+
+            print('\tCopying: ', path)
+            expected = manifest.get(prefix + entry[0])
+            hasher = None
+            if expected:
+                hasher = uhashlib.sha1()
+                hasher.update(b'blob %d\0' % expected[1])  # git hashes the blob header then the content.
+            with open(source_path, 'rb') as infile:
+                with open(path, 'wb') as outfile:
+                    self.bytes_copied += self.copy_stream(infile, outfile, hasher)
+            if hasher and self.hexdigest(hasher) != expected[0]:
+                raise ValueError('Hash mismatch: ' + source_path)
+
+    @staticmethod
+    def load_bundle_index(bundle_dir):
+        """Load the index of the update bundle in bundle_dir, {'modules': {module: {'version', 'path', 'sha256'}}}.
+        The sha1 of the index is added as 'digest' to tell one bundle from another.
+        Returns None if there isn't a bundle."""
+        try:
+            import ubinascii
+            import uhashlib
+            import ujson
+            with open(bundle_dir + '/' + BUNDLE_INDEX, 'rb') as f:
+                data = f.read()
+            index = ujson.loads(data)
+            index['digest'] = str(ubinascii.hexlify(uhashlib.sha1(data).digest()), 'ascii')
+            return index if 'modules' in index else None
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def load_installed_bundle():
+        """The digest of the last bundle installed, or None."""
+        try:
+            with open(INSTALLED_BUNDLE) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    @staticmethod
+    def save_installed_bundle(digest):
+        """Record the digest of the bundle just installed."""
+        with open(INSTALLED_BUNDLE, 'w') as f:
+            f.write(digest)
 
     def apply_pending_updates_if_available(self):
-        """Checks for 'next' directory and version number and overwrites the current 'main' directory."""
+        """Checks for 'next' directory and version number and swaps it in as the 'main' directory.
+        The current 'main' is kept as 'prev' to roll back to and the module is put on trial, see otatrial.rollback().
+        The swap is a rename of each directory rather than a recursive delete of the running code, and the trial
+        file is written first so otatrial.recover() can finish the swap if the power goes part way through."""
         if self.path_exists(self._module) and 'next' in os.listdir(self._module):
-            if '.version' in os.listdir(self.get_module_and_path('next')):
+            if '.version' in os.listdir(self.get_module_and_path('next')) and self.verify_staged():
                 pending_update_version = self.get_version(self.get_module_and_path('next'))
                 print('Pending update found: ', pending_update_version)
+                if self.path_exists(self.get_module_and_path('prev')):
+                    self.rmtree(self.get_module_and_path('prev'))  # Only the old previous version is deleted.
+                import otatrial
+                otatrial.add_to_trial(self._module)
                 if self.path_exists(self.get_module_and_path(self._main_dir)):
-                    self.rmtree(self.get_module_and_path(self._main_dir))  # Remove the 'main' directory and contents.
+                    os.rename(self.get_module_and_path(self._main_dir), self.get_module_and_path('prev'))
                 os.rename(self.get_module_and_path('next'), self.get_module_and_path(self._main_dir))  # Move the 'next' to 'main'
+                self.update_installed_manifest(pending_update_version)
                 print('Update applied (', pending_update_version, ').')
             else:
                 print('Corrupt pending update found, discarding...')
@@ -147,6 +374,53 @@ class OTAUpdater:
         else:
             print('No pending update found')
 
+    def verify_staged(self):
+        """Check every file in the manifest of the 'next' directory is there with the right size. The contents were
+        hashed as they were downloaded so this needs only a stat of each file. Returns True if all is well."""
+        directory = self.get_module_and_path('next')
+        for (path, entry) in self.load_manifest(directory).items():
+            try:
+                if os.stat(directory + '/' + path)[6] != entry[1]:
+                    print('Size mismatch: ', path)
+                    return False
+            except OSError:
+                print('Missing: ', path)
+                return False
+        return True
+
+    def update_installed_manifest(self, version):
+        """Record the version now installed for this module in the installed manifest."""
+        versions = OTAUpdater.load_installed_manifest()
+        if versions is None:
+            versions = {}
+        versions[self._module] = version
+        OTAUpdater.save_installed_manifest(versions)
+
+    @staticmethod
+    def load_installed_manifest():
+        """Load the dictionary of module to installed version. Returns None if there isn't a manifest."""
+        try:
+            import ujson
+            with open(INSTALLED_MANIFEST) as f:
+                return ujson.load(f)['modules']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    @staticmethod
+    def save_installed_manifest(versions):
+        """Save the dictionary of module to installed version. The manifest is written to a temporary file first and
+        then renamed into place, so a reset part way through leaves no manifest (and a scan at boot) rather than a
+        broken one."""
+        import ujson
+        temp_filename = INSTALLED_MANIFEST + '.tmp'
+        with open(temp_filename, 'w') as f:
+            ujson.dump({'modules': versions}, f)
+        try:
+            os.remove(INSTALLED_MANIFEST)  # FAT rename won't replace an existing file.
+        except OSError:
+            pass
+        os.rename(temp_filename, INSTALLED_MANIFEST)
+
     def rmtree(self, directory):
         """Remove the directory tree."""
         for entry in os.ilistdir(directory):
@@ -175,41 +449,373 @@ class OTAUpdater:
 
     def get_latest_version(self):
         """Get the latest release version information from the github repo url.
-        Returns the version or None if no releases exist."""
-        latest_release = self._http_client.get(self._github_repo + '/releases/latest', headers=self.get_headers())
-        if not 'tag_name' in latest_release.json():
-            return None
-        version = latest_release.json()['tag_name']
+        Returns the version or None if no releases exist.
+        The ETag of the last reply is cached so an unchanged release costs a header only 304 Not Modified."""
+        cache = self.load_release_cache()
+        latest_release = self._http_client.get(self._github_repo + '/releases/latest',
+                                               headers=self.get_headers(cache.get('etag')))
+        if latest_release.status_code == 304:
+            latest_release.close()
+            return self._use_release_cache(cache)
+        release = latest_release.json()
         latest_release.close()
-        return version
+        return self._parse_latest_release(release, latest_release.etag)
 
-    def download_all_files(self, root_url, version):
-        """Download all files and directories from the version at the repo url below the 'main' directory."""
+    async def get_latest_version_async(self):
+        """As get_latest_version but lets other uasyncio tasks run while waiting on the network."""
+        import ujson
+        cache = self.load_release_cache()
+        status, headers, body = await self._http_client.request_async('GET', self._github_repo + '/releases/latest',
+                                                                      headers=self.get_headers(cache.get('etag')))
+        if status == 304:
+            return self._use_release_cache(cache)
+        return self._parse_latest_release(ujson.loads(body), headers.get(b'etag'))
+
+    def _use_release_cache(self, cache):
+        """Take the version and release asset from the cache after a 304 Not Modified."""
+        print('\tRelease not modified')
+        self._latest_assets = cache.get('assets', []) if self._release_asset else []
+        return cache.get('tag_name')
+
+    def _parse_latest_release(self, release, etag=None):
+        """Pick the version and any configured release asset out of the latest release json."""
+        if not 'tag_name' in release:
+            return None
+
+        self._latest_assets = []
+        if self._release_asset:
+            for name in (self.get_mpy_asset_name(), self._release_asset):
+                for asset in release.get('assets', []):
+                    if name and asset['name'] == name:
+                        # GitHub gives the sha256 of the asset as 'sha256:<hex>' in its digest.
+                        self._latest_assets.append([name, asset['url'], asset.get('digest')])
+                        break
+
+        if etag:
+            self.save_release_cache(str(etag, 'utf-8'), release['tag_name'], self._latest_assets)
+
+        return release['tag_name']
+
+    def load_release_cache(self):
+        """Load the ETag and details of the last latest release reply. Returns an empty dict if there isn't one."""
+        try:
+            import ujson
+            with open(self.get_module_and_path('.release')) as f:
+                return ujson.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_release_cache(self, etag, tag_name, assets):
+        """Save the ETag and details of the latest release reply."""
+        if self._module and not self.path_exists(self._module):
+            return
+        try:
+            import ujson
+            with open(self.get_module_and_path('.release'), 'w') as f:
+                ujson.dump({'etag': etag, 'tag_name': tag_name, 'assets': assets}, f)
+        except OSError:
+            pass
+
+    def load_manifest(self, directory):
+        """Load the manifest of path to [sha, size] from the directory. Returns an empty dict if there isn't one."""
+        try:
+            import ujson
+            with open(directory + '/.manifest') as f:
+                return ujson.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def download_changed_files(self, version):
+        """Download only the files that differ from the installed version into the 'next' directory.
+        The file list with the git blob sha and size of each file comes from a single git trees request and is
+        compared with the manifest saved alongside the installed version. Unchanged files are copied across locally.
+        Returns False if the tree listing isn't usable, in which case nothing has been written."""
+        tree_response = self._http_client.get(self._github_repo + '/git/trees/' + version + '?recursive=1',
+                                              headers=self.get_headers())
+        if tree_response.status_code != 200:
+            tree_response.close()
+            return False
+        tree = tree_response.json()
+        tree_response.close()
+        if tree.get('truncated') or not 'tree' in tree:
+            return False
+
+        prefix = self._main_dir + '/'
+        installed_dir = self.get_module_and_path(self._main_dir)
+        installed_manifest = self.load_manifest(installed_dir)
+        manifest = {}
+        for entry in tree['tree']:
+            if not entry['path'].startswith(prefix):
+                continue
+            path = entry['path'][len(prefix):]
+            next_path = self.get_module_and_path('next/' + path)
+            if entry['type'] == 'tree':
+                os.mkdir(next_path)
+            elif entry['type'] == 'blob':
+                manifest[path] = [entry['sha'], entry['size']]
+                if installed_manifest.get(path) == manifest[path] and self.path_exists(installed_dir + '/' + path):
+                    print('\tUnchanged: ', next_path)
+                    with open(installed_dir + '/' + path, 'rb') as infile:
+                        with open(next_path, 'wb') as outfile:
+                            self.copy_stream(infile, outfile)
+                    self.bytes_saved += entry['size']
+                else:
+                    self.download_file(self._github_raw + '/' + version + '/' + entry['path'], next_path,
+                                       entry['size'], entry['sha'])
+                    self.bytes_downloaded += entry['size']
+        del tree
+        gc.collect()
+
+        import ujson
+        with open(self.get_module_and_path('next/.manifest'), 'w') as manifest_file:
+            ujson.dump(manifest, manifest_file)
+
+        print('\tBytes downloaded: ', self.bytes_downloaded, ' Bytes saved: ', self.bytes_saved)
+        return True
+
+    def download_all_files(self, root_url, version, manifest=None):
+        """Download all files and directories from the version at the repo url below the 'main' directory.
+        Each file is checked against the git blob sha and size listed for it by the contents API, and these are saved
+        as the manifest of the 'next' directory as download_changed_files() does."""
+        top = manifest is None
+        if top:
+            manifest = {}
         file_list = self._http_client.get(root_url + '?ref=refs/tags/' + version, headers=self.get_headers())
-        for file in file_list.json():
+        files = file_list.json()
+        file_list.close()
+        for file in files:
+            path = file['path'].replace(self._main_dir + '/', '')
             if file['type'] == 'file':
                 download_url = file['download_url']
-                download_path = self.get_module_and_path('next/' + file['path'].replace(self._main_dir + '/', ''))
-                self.download_file(download_url.replace('refs/tags/', ''), download_path)
+                self.download_file(download_url.replace('refs/tags/', ''), self.get_module_and_path('next/' + path),
+                                   file['size'], file['sha'])
+                self.bytes_downloaded += file['size']
+                manifest[path] = [file['sha'], file['size']]
             elif file['type'] == 'dir':
-                path = self.get_module_and_path('next/' + file['path'].replace(self._main_dir + '/', ''))
-                os.mkdir(path)
-                self.download_all_files(root_url + '/' + file['name'], version)  # Recurse into the subdirectory.
+                os.mkdir(self.get_module_and_path('next/' + path))
+                self.download_all_files(root_url + '/' + file['name'], version, manifest)  # Recurse into it.
+        del files
 
-        file_list.close()
+        if top:
+            import ujson
+            with open(self.get_module_and_path('next/.manifest'), 'w') as manifest_file:
+                ujson.dump(manifest, manifest_file)
+
+    def get_mpy_asset_name(self):
+        """Name of the precompiled variant of the release asset for this firmware, e.g. main-mpy6-armv7emsp.tar
+        for main.tar. Returns None if the firmware doesn't report its .mpy version."""
+        mpy = self.get_mpy_abi()
+        if not mpy or not self._release_asset:
+            return None
+        arch = mpy >> 10
+        arch_name = MPY_ARCH_NAMES[arch] if arch < len(MPY_ARCH_NAMES) else str(arch)
+        base, dot, extension = self._release_asset.rpartition('.')
+        if not dot:
+            base, extension = extension, ''
+        return base + '-mpy' + str(mpy & 0xff) + ('-' + arch_name if arch_name else '') + dot + extension
+
+    @staticmethod
+    def get_mpy_abi():
+        """The .mpy version and architecture the firmware loads, or None if it doesn't say."""
+        import sys
+        return getattr(sys.implementation, '_mpy', getattr(sys.implementation, 'mpy', None))
+
+    def validate_mpy_files(self, directory):
+        """Check every .mpy file below the directory was compiled for this firmware. Raises ValueError if not."""
+        mpy = self.get_mpy_abi()
+        header = bytearray(2)
+        for entry in os.ilistdir(directory):
+            path = directory + '/' + entry[0]
+            if entry[1] == 0x4000:
+                self.validate_mpy_files(path)
+            elif entry[0].endswith('.mpy'):
+                with open(path, 'rb') as f:
+                    n = f.readinto(header)
+                if n != 2 or header[0] != ord('M') or (mpy and header[1] != mpy & 0xff):
+                    raise ValueError('Incompatible mpy file: ' + path)
+
+    def download_release_assets(self):
+        """Download and unpack the first of the release assets that works into the 'next' directory.
+        Returns False, with the 'next' directory left empty, if none are available or they all failed."""
+        for asset in self._latest_assets:
+            try:
+                self.download_release_asset(asset[0], asset[1], asset[2] if len(asset) > 2 else None)
+                self.validate_mpy_files(self.get_module_and_path('next'))
+                return True
+            except (OSError, ValueError) as the_exception:
+                import sys
+                sys.print_exception(the_exception)
+                self.rmtree(self.get_module_and_path('next'))
+                os.mkdir(self.get_module_and_path('next'))
+        return False
+
+    def download_release_asset(self, name, url, digest=None):
+        """Download the release asset tar from the url and unpack its 'main' directory into the 'next' directory.
+        If a 'sha256:<hex>' digest is given the asset is hashed as it streams and ValueError raised on a mismatch."""
+        print('\tDownloading asset: ', name)
+        headers = self.get_headers()
+        headers[b'Accept'] = b'application/octet-stream'  # The asset itself rather than its json description.
+        response = None
+        try:
+            response = self._http_client.get(url, headers=headers)
+            if response.status_code != 200:
+                raise OSError('Asset download failed: ' + str(response.status_code))
+            instream = response
+            if digest and digest.startswith('sha256:'):
+                import uhashlib
+                instream = HashingReader(response, uhashlib.sha256())
+            self.extract_tar(instream, self.get_module_and_path('next'))
+            if instream is not response:
+                self.copy_stream(instream, None)  # Hash the padding after the end of archive marker.
+                if 'sha256:' + self.hexdigest(instream.hasher) != digest:
+                    raise ValueError('Hash mismatch: ' + name)
+        finally:
+            if response:
+                response.close()
+            gc.collect()
+
+    def extract_tar(self, instream, directory):
+        """Extract the entries below the main directory of an uncompressed tar stream into directory.
+        The archive is made in the module repo with 'tar -cf main.tar main'. Returns the number of files extracted."""
+        header = bytearray(512)
+        prefix = self._main_dir + '/'
+        long_name = None
+        count = 0
+        while True:
+            self._read_exactly(instream, header, 512)
+            if header[0] == 0:
+                break  # End of archive marker
+
+            size = int(str(bytes(header[124:136]).rstrip(b'\0 ') or b'0', 'ascii'), 8)
+            entry_type = header[156]
+            if long_name:
+                name = long_name
+                long_name = None
+            else:
+                name = self._tar_string(header, 0, 100)
+                if header[257:262] == b'ustar':
+                    name_prefix = self._tar_string(header, 345, 155)
+                    if name_prefix:
+                        name = name_prefix + '/' + name
+            if name.startswith('./'):
+                name = name[2:]
 
-    def download_file(self, url, path):
-        """Download file from the url to the given path."""
+            padding = (512 - size % 512) % 512
+            if entry_type == ord('L') or entry_type == ord('x'):
+                # GNU long name or pax extended header, either can carry the name of the following entry.
+                data = bytearray(size + padding)
+                self._read_exactly(instream, data, size + padding)
+                data = bytes(data[:size])
+                if entry_type == ord('L'):
+                    long_name = str(data.rstrip(b'\0'), 'utf-8')
+                else:
+                    for record in data.split(b'\n'):
+                        if b' path=' in record:
+                            long_name = str(record.split(b' path=', 1)[1], 'utf-8')
+                continue
+
+            path = None
+            if name.startswith(prefix) and len(name.rstrip('/')) > len(prefix):
+                path = directory + '/' + name[len(prefix):].rstrip('/')
+
+            if path and entry_type == ord('5'):
+                if not self.path_exists(path):
+                    os.mkdir(path)
+            elif path and (entry_type == ord('0') or entry_type == 0):
+                print('\tExtracting: ', path)
+                with open(path, 'wb') as outfile:
+                    self._copy_exactly(instream, outfile, size)
+                    outfile.close()
+                count += 1
+                size = 0  # Already consumed
+            # Skip the data of anything else (pax headers, links, files outside of the main directory).
+            self._copy_exactly(instream, None, size + padding)
+        return count
+
+    @staticmethod
+    def _tar_string(header, offset, length):
+        """Decode a nul terminated string field from a tar header."""
+        field = bytes(header[offset:offset + length])
+        end = field.find(b'\0')
+        if end >= 0:
+            field = field[:end]
+        return str(field, 'utf-8')
+
+    @staticmethod
+    def _read_exactly(instream, buf, n):
+        """Fill the first n bytes of buf from instream."""
+        mv = memoryview(buf)
+        pos = 0
+        while pos < n:
+            r = instream.readinto(mv[pos:n])
+            if not r:
+                raise ValueError('Truncated archive')
+            pos += r
+
+    def _copy_exactly(self, instream, outfile, n):
+        """Copy exactly n bytes from instream to outfile through the buffer. If outfile is None they are skipped."""
+        mv = memoryview(self._buffer)
+        size = len(self._buffer)
+        while n > 0:
+            r = instream.readinto(mv[:n if n < size else size])
+            if not r:
+                raise ValueError('Truncated archive')
+            if outfile:
+                outfile.write(mv[:r])
+            n -= r
+
+    def download_file(self, url, path, size=None, sha=None):
+        """Download file from the url to the given path.
+        The body is streamed through the preallocated buffer so peak memory does not depend on the file size.
+        If given, the size and git blob sha are checked as the file streams in. Raises ValueError on a mismatch."""
         print('\tDownloading: ', path)
-        with open(path, 'w') as outfile:
+        hasher = None
+        if sha:
+            import uhashlib
+            hasher = uhashlib.sha1()
+            hasher.update(b'blob %d\0' % size)  # git hashes the blob header then the content.
+        response = None
+        with open(path, 'wb') as outfile:
             try:
                 response = self._http_client.get(url, headers=self.get_headers())
-                outfile.write(response.text)
+                if response.status_code != 200:
+                    raise OSError('Download failed: ' + str(response.status_code))
+                total = self.copy_stream(response, outfile, hasher)
             finally:
-                response.close()
+                if response:
+                    response.close()
                 outfile.close()
                 gc.collect()
 
+        if size is not None and total != size:
+            raise ValueError('Size mismatch: ' + path)
+        if hasher and self.hexdigest(hasher) != sha:
+            raise ValueError('Hash mismatch: ' + path)
+
+    @staticmethod
+    def hexdigest(hasher):
+        """Hex string of the hasher's digest."""
+        import ubinascii
+        return str(ubinascii.hexlify(hasher.digest()), 'ascii')
+
+    def copy_stream(self, instream, outfile, hasher=None):
+        """Copy everything from instream to outfile in buffer sized chunks, updating the hasher if given along the way
+        so there's no second pass to verify. outfile can be None to just read to the end.
+        Returns the number of bytes copied."""
+        buf = self._buffer
+        mv = memoryview(buf)
+        total = 0
+        while True:
+            n = instream.readinto(buf)
+            if not n:
+                break
+            if hasher:
+                hasher.update(mv[:n])
+            if outfile:
+                outfile.write(mv[:n])
+            total += n
+        return total
+
     def get_module_and_path(self, path):
         """Get the combined path of module and the provided path appended."""
         return self._module + '/' + path if self._module else path
@@ -222,36 +828,129 @@ class OTAUpdater:
             return False
         return True
 
-    def get_headers(self):
-        """Generate the extra headers."""
+    def get_headers(self, etag=None):
+        """Generate the extra headers. With an etag the request is made conditional on the resource having changed."""
         headers={}
         if self._github_pat:
             headers = { b'Authorization': b'token {}'.format(self._github_pat) }
+        if etag:
+            headers[b'If-None-Match'] = etag.encode()
 
         return headers
 
 class Response:
     """HTTP Response."""
 
-    def __init__(self, f):
+    def __init__(self, f, client=None, key=None, length=None, keep_alive=False, chunked=False):
+        """Response body on socket f. length is the Content-Length or None to read until the server closes.
+        A chunked body is decoded incrementally as it is read.
+        If keep_alive the socket is handed back to the client's pool once the body has been fully read."""
         self.raw = f
         self.encoding = 'utf-8'
         self._cached = None
+        self._client = client
+        self._key = key
+        self._remaining = length
+        self._chunked = chunked
+        self._chunk_left = 0
+        self._keep_alive = keep_alive and (chunked or length is not None)
 
     def close(self):
         if self.raw:
-            self.raw.close()
+            if self._keep_alive and self._remaining == 0:
+                self._client.release(self._key, self.raw)
+            else:
+                self.raw.close()
             self.raw = None
         self._cached = None
 
+    def _finish(self, complete=True):
+        """End of body. Return the socket to the pool if it can carry another request, else close it."""
+        if self.raw:
+            if complete and self._keep_alive:
+                self._client.release(self._key, self.raw)
+            else:
+                self.raw.close()
+            self.raw = None
+
+    def _next_chunk(self):
+        """Read the next chunk size line. Returns False after the last chunk and its trailers."""
+        l = self.raw.readline()
+        if not l:
+            self._finish(False)
+            return False
+        self._chunk_left = int(l.split(b';', 1)[0].strip(), 16)
+        if self._chunk_left == 0:
+            # Skip any trailer headers up to the blank line that ends the body.
+            while True:
+                l = self.raw.readline()
+                if not l or l == b'\r\n':
+                    break
+            self._finish(bool(l))
+            return False
+        return True
+
+    def readinto(self, buf):
+        """Read the next part of the body into buf. Returns the number of bytes read, 0 at the end."""
+        if not self.raw:
+            return 0
+        if self._chunked:
+            if self._chunk_left == 0 and not self._next_chunk():
+                return 0
+            if self._chunk_left < len(buf):
+                buf = memoryview(buf)[:self._chunk_left]
+            n = self.raw.readinto(buf)
+            if not n:
+                self._finish(False)
+                raise ValueError('Truncated response')
+            self._chunk_left -= n
+            if self._chunk_left == 0:
+                self.raw.readline()  # CRLF at the end of the chunk data
+            return n
+        if self._remaining is not None:
+            if self._remaining <= 0:
+                self._finish()
+                return 0
+            if self._remaining < len(buf):
+                buf = memoryview(buf)[:self._remaining]
+        n = self.raw.readinto(buf)
+        if not n:
+            self._finish(self._remaining is None)
+            if self._remaining:
+                raise ValueError('Truncated response')
+            return 0
+        if self._remaining is not None:
+            self._remaining -= n
+            if self._remaining <= 0:
+                self._finish()
+        return n
+
     @property
     def content(self):
         if self._cached is None:
-            try:
-                self._cached = self.raw.read()
-            finally:
-                self.raw.close()
-                self.raw = None
+            if not self.raw:
+                self._cached = b''
+            elif self._chunked:
+                body = bytearray()
+                buf = bytearray(256)
+                n = self.readinto(buf)
+                while n:
+                    body.extend(memoryview(buf)[:n])
+                    n = self.readinto(buf)
+                self._cached = bytes(body)
+            elif self._remaining is None:
+                try:
+                    self._cached = self.raw.read()
+                finally:
+                    self._finish(False)
+            else:
+                try:
+                    self._cached = self.raw.read(self._remaining) if self._remaining > 0 else b''
+                    self._remaining -= len(self._cached)
+                finally:
+                    self._finish(self._remaining == 0)
+                if self._remaining:
+                    raise ValueError('Truncated response')
         return self._cached
 
     @property
@@ -263,10 +962,111 @@ class Response:
         return ujson.loads(self.content)
 
 
+class HashingReader:
+    """Wraps a stream to update the hasher with everything read through readinto()."""
+
+    def __init__(self, stream, hasher):
+        self._stream = stream
+        self.hasher = hasher
+
+    def readinto(self, buf):
+        n = self._stream.readinto(buf)
+        if n:
+            self.hasher.update(memoryview(buf)[:n])
+        return n
+
+
 class HttpClient:
-    """HTTP Client."""
+    """HTTP Client.
+    With keep_alive the client speaks HTTP/1.1 and keeps one idle connection per host (up to pool_size hosts) so
+    that following requests to the same host skip the DNS lookup, TCP connect and TLS handshake. request_async()
+    keeps up to async_pool_size connections per host of its own."""
+
+    def __init__(self, keep_alive=True, pool_size=2, async_pool_size=3):
+        self._keep_alive = keep_alive
+        self._pool_size = pool_size
+        self._pool = []  # Idle connections as [key, socket] with the most recently used last.
+        self._async_pool_size = async_pool_size
+        self._async_pool = {}  # Key to the list of idle uasyncio connections as (reader, writer).
+        self._async_open = {}  # Key to the number of uasyncio connections open, idle or in use.
+        self._async_waiters = {}  # Key to the uasyncio.Event set when a connection is released or closed.
+        self._async_ssl = None  # The SSLContext for request_async(), made on first use.
+        self.connections_opened = 0  # Number of connect (and TLS handshake) operations.
+        self.handshakes_saved = 0  # Number of requests sent on a pooled connection.
+
+    def close(self):
+        """Close all idle pooled connections."""
+        for entry in self._pool:
+            entry[1].close()
+        self._pool = []
+
+    def release(self, key, s):
+        """Return an idle connection to the pool, closing the least recently used one if the pool is full."""
+        if not self._keep_alive:
+            s.close()
+            return
+        self._pool.append([key, s])
+        if len(self._pool) > self._pool_size:
+            self._pool.pop(0)[1].close()
+
+    def _acquire(self, key):
+        """Take an idle connection for key from the pool. Returns None if there isn't one."""
+        for i in range(len(self._pool)):
+            if self._pool[i][0] == key:
+                return self._pool.pop(i)[1]
+        return None
+
+    def _connect(self, proto, host, port):
+        """Open a new connection to the host."""
+        ai = usocket.getaddrinfo(host, port, 0, usocket.SOCK_STREAM)
+        ai = ai[0]
+
+        s = usocket.socket(ai[0], ai[1], ai[2])
+        try:
+            # Set Timeout (in seconds) to make it non-blocking.
+            s.settimeout(5)
+            s.connect(ai[-1])
+            if proto == 'https:':
+                import ussl
+                s = ussl.wrap_socket(s, server_hostname=host)
+        except OSError:
+            s.close()
+            raise
+        self.connections_opened += 1
+        return s
 
-    def request(self, method, url, data=None, json=None, headers={}, stream=None):
+    def _send(self, s, method, host, path, data, json, headers):
+        """Write the request line, headers and body and return the status line."""
+        s.write(method + ' /' + path + (' HTTP/1.1\r\n' if self._keep_alive else ' HTTP/1.0\r\n'))
+        if not 'Host' in headers:
+            s.write('Host: ' + host + '\r\n')
+        # Iterate over keys to avoid tuple alloc
+        for k in headers:
+            s.write(k)
+            s.write(b': ')
+            s.write(headers[k])
+            s.write(b'\r\n')
+        # add user agent
+        s.write('User-Agent')
+        s.write(b': ')
+        s.write('MicroPython OTAUpdater')
+        s.write(b'\r\n')
+        if json is not None:
+            assert data is None
+            import ujson
+            data = ujson.dumps(json)
+            s.write(b'Content-Type: application/json\r\n')
+        if data:
+            s.write('Content-Length: %d\r\n' % len(data))
+        s.write(b'\r\n')
+        if data:
+            s.write(data)
+
+        return s.readline()
+
+    @staticmethod
+    def _split_url(url):
+        """Split the url into protocol, host, port and path."""
         try:
             proto, dummy, host, path = url.split('/', 3)
         except ValueError:
@@ -275,7 +1075,6 @@ class HttpClient:
         if proto == 'http:':
             port = 80
         elif proto == 'https:':
-            import ussl
             port = 443
         else:
             raise ValueError('Unsupported protocol: ' + proto)
@@ -284,65 +1083,269 @@ class HttpClient:
             host, port = host.split(':', 1)
             port = int(port)
 
-        ai = usocket.getaddrinfo(host, port, 0, usocket.SOCK_STREAM)
-        ai = ai[0]
+        return proto, host, port, path
 
-        s = usocket.socket(ai[0], ai[1], ai[2])
+    @staticmethod
+    def async_supported():
+        """True if request_async() can be used. It needs uasyncio.open_connection to take ssl, which came in
+        MicroPython v1.21, so this is checked once up front rather than failing on every request."""
+        import sys
         try:
-            # Set Timeout (in seconds) to make it non-blocking.
-            s.settimeout(5)
-            s.connect(ai[-1])
-            if proto == 'https:':
-                s = ussl.wrap_socket(s, server_hostname=host)
-            s.write(b'%s /%s HTTP/1.0\r\n' % (method, path))
-            if not 'Host' in headers:
-                s.write(b'Host: %s\r\n' % host)
-            # Iterate over keys to avoid tuple alloc
-            for k in headers:
-                s.write(k)
-                s.write(b': ')
-                s.write(headers[k])
-                s.write(b'\r\n')
-            # add user agent
-            s.write('User-Agent')
-            s.write(b': ')
-            s.write('MicroPython OTAUpdater')
-            s.write(b'\r\n')
-            if json is not None:
-                assert data is None
-                import ujson
-                data = ujson.dumps(json)
-                s.write(b'Content-Type: application/json\r\n')
-            if data:
-                s.write(b'Content-Length: %d\r\n' % len(data))
-            s.write(b'\r\n')
-            if data:
-                s.write(data)
+            import uasyncio
+        except ImportError:
+            return False
+        return sys.implementation.name != 'micropython' or sys.implementation.version >= (1, 21, 0)
+
+    async def request_async(self, method, url, headers={}):
+        """Send a request on a uasyncio stream so other tasks keep running while waiting on the network.
+        As with request() the connection is kept open for the next request to the same host. Up to async_pool_size
+        requests to the same host run at once, each on its own connection, and further requests wait for one of them
+        to be free, so checking several modules costs at most async_pool_size TLS handshakes. The whole body is read
+        into memory, so this is meant for small replies such as the release json.
+        Returns (status, headers, body) with the header names in lower case."""
+        proto, host, port, path = self._split_url(url)
+        key = (proto, host, port)
+        streams = await self._acquire_async(key)
+        reply = None
+        if streams:
+            try:
+                reply = await self._exchange_async(streams, method, host, path, headers)
+            except (OSError, ValueError, IndexError):
+                reply = None
+            if reply:
+                self.handshakes_saved += 1
+            else:
+                # The server closed the idle connection, so start again on a new one in its place.
+                await self._close_async(streams)
+        if not reply:
+            try:
+                streams = await self._connect_async(proto, host, port)
+            except Exception:
+                self._release_slot(key)
+                raise
+            self.connections_opened += 1
+            try:
+                reply = await self._exchange_async(streams, method, host, path, headers)
+                if not reply:
+                    raise OSError('Connection closed')
+            except Exception:
+                await self._close_async(streams)
+                self._release_slot(key)
+                raise
+
+        status, response_headers, body, keep_alive = reply
+        if keep_alive:
+            self._async_pool.setdefault(key, []).append(streams)
+            self._wake_async(key)
+        else:
+            await self._close_async(streams)
+            self._release_slot(key)
+        return status, response_headers, body
+
+    async def _acquire_async(self, key):
+        """Take an idle connection to the host, or None with a slot reserved to open a new one, waiting while there
+        are already async_pool_size connections in use."""
+        import uasyncio
+        while True:
+            idle = self._async_pool.get(key)
+            if idle:
+                return idle.pop()
+            if self._async_open.get(key, 0) < self._async_pool_size:
+                self._async_open[key] = self._async_open.get(key, 0) + 1
+                return None
+            event = self._async_waiters.get(key)
+            if event is None:
+                event = uasyncio.Event()
+                self._async_waiters[key] = event
+            await event.wait()
+
+    def _release_slot(self, key):
+        """Give back the slot of a connection to the host that has been closed."""
+        self._async_open[key] -= 1
+        self._wake_async(key)
+
+    def _wake_async(self, key):
+        event = self._async_waiters.pop(key, None)
+        if event:
+            event.set()
+
+    async def _connect_async(self, proto, host, port):
+        import uasyncio
+        if proto != 'https:':
+            return await uasyncio.open_connection(host, port)
+        if not self._async_ssl:
+            # With ssl=True uasyncio makes a PROTOCOL_TLS_CLIENT context, which verifies the server certificate, and
+            # no CA certificates are loaded. Leave verification off as ussl.wrap_socket() does for request().
+            import ssl
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            self._async_ssl = context
+        return await uasyncio.open_connection(host, port, ssl=self._async_ssl, server_hostname=host)
 
-            l = s.readline()
+    async def _exchange_async(self, streams, method, host, path, headers):
+        """Send the request and read the whole reply. Returns (status, headers, body, keep_alive) or None if the
+        connection had been closed."""
+        reader, writer = streams
+        writer.write((method + ' /' + path + (' HTTP/1.1\r\n' if self._keep_alive else ' HTTP/1.0\r\n')
+                      + 'Host: ' + host + '\r\n').encode())
+        for k in headers:
+            writer.write(k)
+            writer.write(b': ')
+            writer.write(headers[k])
+            writer.write(b'\r\n')
+        writer.write(b'User-Agent: MicroPython OTAUpdater\r\n\r\n')
+        await writer.drain()
+
+        l = await reader.readline()
+        if not l:
+            return None
+        l = l.split(None, 2)
+        keep_alive = self._keep_alive and l[0] != b'HTTP/1.0'
+        status = int(l[1])
+        response_headers = {}
+        while True:
+            l = await reader.readline()
+            if not l or l == b'\r\n':
+                break
+            name, value = l.split(b':', 1)
+            response_headers[name.strip().lower()] = value.strip()
+        if b'close' in response_headers.get(b'connection', b''):
+            keep_alive = False
+
+        if method == 'HEAD' or status == 204 or status == 304 or 100 <= status <= 199:
+            body = b''
+        elif b'chunked' in response_headers.get(b'transfer-encoding', b''):
+            body = b''
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if not size:
+                    break
+                body += await reader.readexactly(size)
+                await reader.readline()  # The CRLF after the chunk.
+            # Skip any trailer headers up to the blank line that ends the body.
+            while True:
+                l = await reader.readline()
+                if not l or l == b'\r\n':
+                    break
+        elif b'content-length' in response_headers:
+            body = await reader.readexactly(int(response_headers[b'content-length']))
+        else:
+            # The body ends when the server closes.
+            keep_alive = False
+            body = b''
+            while True:
+                data = await reader.read(512)
+                if not data:
+                    break
+                body += data
+        return status, response_headers, body, keep_alive
+
+    @staticmethod
+    async def _close_async(streams):
+        streams[1].close()
+        try:
+            await streams[1].wait_closed()
+        except OSError:
+            pass
+
+    async def close_async(self):
+        """Close all idle uasyncio connections."""
+        for key in list(self._async_pool):
+            for streams in self._async_pool.pop(key):
+                await self._close_async(streams)
+                self._release_slot(key)
+
+    def request(self, method, url, data=None, json=None, headers={}, stream=None, max_redirects=5):
+        """Send the request and return the Response once the headers have been read.
+        Redirects are followed up to max_redirects times."""
+        proto, host, port, path = self._split_url(url)
+
+        key = (proto, host, port)
+        s = self._acquire(key)
+        if s:
+            try:
+                l = self._send(s, method, host, path, data, json, headers)
+            except OSError:
+                l = None
+            if l:
+                self.handshakes_saved += 1
+            else:
+                # The server closed the idle connection, so start again on a new one.
+                s.close()
+                s = None
+        if not s:
+            s = self._connect(proto, host, port)
+            try:
+                l = self._send(s, method, host, path, data, json, headers)
+            except OSError:
+                s.close()
+                raise
+
+        try:
             # print(l)
             l = l.split(None, 2)
+            keep_alive = self._keep_alive and l[0] != b'HTTP/1.0'
             status = int(l[1])
             reason = ''
             if len(l) > 2:
                 reason = l[2].rstrip()
+            length = None
+            chunked = False
+            location = None
+            etag = None
             while True:
                 l = s.readline()
                 if not l or l == b'\r\n':
                     break
                 # print(l)
-                if l.startswith(b'Transfer-Encoding:'):
-                    if b'chunked' in l:
-                        raise ValueError('Unsupported ' + l)
-                elif l.startswith(b'Location:') and not 200 <= status <= 299:
-                    raise NotImplementedError('Redirects not yet supported')
-        except OSError:
+                h = l.lower()
+                if h.startswith(b'transfer-encoding:'):
+                    chunked = b'chunked' in h
+                elif h.startswith(b'content-length:'):
+                    length = int(h[15:])
+                elif h.startswith(b'connection:'):
+                    keep_alive = keep_alive and not b'close' in h
+                elif h.startswith(b'location:'):
+                    location = str(l[9:].strip(), 'utf-8')
+                elif h.startswith(b'etag:'):
+                    etag = l[5:].strip()
+        except (OSError, ValueError):
             s.close()
             raise
 
-        resp = Response(s)
+        if method == 'HEAD' or status == 204 or status == 304 or 100 <= status <= 199:
+            length = 0
+            chunked = False
+        elif chunked:
+            length = None
+
+        resp = Response(s, self, key, length, keep_alive, chunked)
         resp.status_code = status
         resp.reason = reason
+        resp.etag = etag
+
+        if location and status in (301, 302, 303, 307, 308):
+            if max_redirects <= 0:
+                resp.close()
+                raise ValueError('Too many redirects')
+            # Read off a short body so the connection can go back to the pool for the redirect or a later request.
+            if chunked or (length is not None and length <= 1024):
+                resp.content
+            resp.close()
+
+            if location.startswith('/'):
+                location = proto + '//' + host + (':' + str(port) if port not in (80, 443) else '') + location
+            if self._split_url(location)[:3] != key:
+                # Don't hand credentials on to another host (e.g. release assets are served from a storage host).
+                headers = {k: headers[k] for k in headers if k not in (b'Authorization', 'Authorization')}
+            if status == 303:
+                method = 'GET'
+                data = None
+                json = None
+            return self.request(method, location, data=data, json=json, headers=headers, stream=stream,
+                                max_redirects=max_redirects - 1)
+
         return resp
 
     def head(self, url, **kw):
@@ -0,0 +1,193 @@
+#! /usr/bin/env python
+#
+# MicroPython USMART OTA Trial. Finishes, counts and rolls back the module updates applied by the OTA updater.
+#
+# This file is part of micropython-usmart-sensor-application.
+# https://github.com/bensherlock/micropython-usmart-sensor-application
+#
+#
+# MIT License
+#
+# Copyright (c) 2020 Benjamin Sherlock <benjamin.sherlock@ncl.ac.uk>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""MicroPython USMART OTA Trial.
+
+Kept apart from ota_updater, which is itself one of the modules updated over the air, so that an ota_updater caught
+part way through its swap or broken by a bad release can still be put right at boot. Needs nothing but os and ujson."""
+
+import os
+
+# Modules whose update is on trial and the boots counted since, until the update is confirmed or rolled back.
+TRIAL_FILE = 'ota_trial.json'
+
+# Versions of the installed modules kept by ota_updater. Removed when a swap is finished or undone here so the next
+# read rescans the module directories.
+INSTALLED_MANIFEST = 'installed_manifest.json'
+
+MAIN_DIR = 'main'
+
+
+def _exists(path):
+    try:
+        os.stat(path)
+    except OSError:
+        return False
+    return True
+
+
+def _rmtree(directory):
+    for entry in os.ilistdir(directory):
+        if entry[1] == 0x4000:
+            _rmtree(directory + '/' + entry[0])
+        else:
+            os.remove(directory + '/' + entry[0])
+    os.rmdir(directory)
+
+
+def forget_installed_versions():
+    """Remove the installed manifest so that the module versions are scanned again at the next boot."""
+    try:
+        os.remove(INSTALLED_MANIFEST)
+    except OSError:
+        pass
+
+
+def load_trial():
+    """Load the trial as a dictionary with the list of 'modules' and the 'boots' counted.
+    Returns None if there are no modules on trial."""
+    import ujson
+    for filename in (TRIAL_FILE, TRIAL_FILE + '.tmp'):  # The temporary file if reset part way through a save.
+        try:
+            with open(filename) as f:
+                return ujson.load(f)
+        except (OSError, ValueError):
+            pass
+    return None
+
+
+def save_trial(trial):
+    """Save the trial, written to a temporary file first and then renamed into place.
+    Pass None to end the trial."""
+    if trial is not None:
+        import ujson
+        with open(TRIAL_FILE + '.tmp', 'w') as f:
+            ujson.dump(trial, f)
+    try:
+        os.remove(TRIAL_FILE)  # FAT rename won't replace an existing file.
+    except OSError:
+        pass
+    if trial is not None:
+        os.rename(TRIAL_FILE + '.tmp', TRIAL_FILE)
+    else:
+        try:
+            os.remove(TRIAL_FILE + '.tmp')
+        except OSError:
+            pass
+
+
+def add_to_trial(module):
+    """Put the module on trial with the boot count restarted. Called before its update is swapped in."""
+    trial = load_trial()
+    if trial is None:
+        trial = {'modules': []}
+    if module not in trial['modules']:
+        trial['modules'].append(module)
+    trial['boots'] = 0
+    save_trial(trial)
+
+
+def recover(module):
+    """Finish a swap of the module that was interrupted, leaving a 'main' directory in place. The staged 'next' is
+    used if it is complete, otherwise the 'prev' version is put back. Returns True if anything was done."""
+    main_path = module + '/' + MAIN_DIR
+    if _exists(main_path):
+        return False
+    next_path = module + '/next'
+    if _exists(next_path + '/.version') and _verify_staged(next_path):
+        os.rename(next_path, main_path)
+    elif _exists(module + '/prev'):
+        os.rename(module + '/prev', main_path)
+    else:
+        return False
+    print('Recovered: ', module)
+    forget_installed_versions()
+    return True
+
+
+def recover_trial():
+    """Recover each module on trial. Only needs the trial file to be read when no update is on trial."""
+    trial = load_trial()
+    if trial:
+        for module in trial['modules']:
+            recover(module)
+
+
+def _verify_staged(directory):
+    """Check every file in the manifest of the staged directory is there with the right size."""
+    try:
+        import ujson
+        with open(directory + '/.manifest') as f:
+            manifest = ujson.load(f)
+    except (OSError, ValueError):
+        return True  # Staged without a manifest.
+    for (path, entry) in manifest.items():
+        try:
+            if os.stat(directory + '/' + path)[6] != entry[1]:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def rollback(module):
+    """Put the 'prev' version of the module back as 'main' and discard the version that failed.
+    Returns True if rolled back, False if there is no previous version."""
+    prev_path = module + '/prev'
+    main_path = module + '/' + MAIN_DIR
+    if not _exists(prev_path):
+        return False
+    failed_path = module + '/failed'
+    if _exists(failed_path):
+        _rmtree(failed_path)
+    if _exists(main_path):
+        os.rename(main_path, failed_path)
+    os.rename(prev_path, main_path)  # A reset before here is put right by recover()
+    forget_installed_versions()
+    if _exists(failed_path):
+        _rmtree(failed_path)
+    print('Rolled back: ', module)
+    return True
+
+
+def rollback_trial():
+    """Roll back every module on trial and end the trial. Returns the list of modules rolled back."""
+    trial = load_trial()
+    rolled_back = []
+    if trial:
+        for module in trial['modules']:
+            try:
+                if rollback(module):
+                    rolled_back.append(module)
+            except OSError as the_exception:
+                import sys
+                sys.print_exception(the_exception)
+        save_trial(None)
+    return rolled_back
@@ -0,0 +1,87 @@
+#! /usr/bin/env python
+#
+# MicroPython USMART Phase Timer. Records how long each phase of the startup takes.
+#
+# This file is part of micropython-usmart-sensor-application.
+# https://github.com/bensherlock/micropython-usmart-sensor-application
+#
+#
+# MIT License
+#
+# Copyright (c) 2020 Benjamin Sherlock <benjamin.sherlock@ncl.ac.uk>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""MicroPython USMART Phase Timer."""
+
+import utime
+from array import array
+
+_phase_timer = None
+
+
+class PhaseTimer:
+    """Phase Timer.
+    The tables are allocated up front so that marking a phase doesn't allocate. Use string literals for the names."""
+
+    def __init__(self, max_phases=16):
+        self._names = [None] * max_phases
+        self._ticks = array('l', [0] * max_phases)
+        self._count = 0
+        self._start = utime.ticks_us()
+
+    def mark(self, name):
+        """Mark the end of the named phase, which started at the previous mark."""
+        if self._count < len(self._names):
+            self._ticks[self._count] = utime.ticks_us()
+            self._names[self._count] = name
+            self._count += 1
+
+    def get_durations(self):
+        """Get a dictionary of phase name to duration in microseconds."""
+        durations = {}
+        previous = self._start
+        for i in range(self._count):
+            durations[self._names[i]] = utime.ticks_diff(self._ticks[i], previous)
+            previous = self._ticks[i]
+        return durations
+
+    def get_total(self):
+        """Get the time from the start to the last mark in microseconds."""
+        if not self._count:
+            return 0
+        return utime.ticks_diff(self._ticks[self._count - 1], self._start)
+
+    def summary(self):
+        """One line summary of the phase durations in milliseconds."""
+        line = "phases_ms"
+        previous = self._start
+        for i in range(self._count):
+            line += " " + self._names[i] + "=" + str(utime.ticks_diff(self._ticks[i], previous) // 1000)
+            previous = self._ticks[i]
+        return line + " total=" + str(self.get_total() // 1000)
+
+
+def get_phase_timer():
+    """Get the phase timer. The first call starts the clock, so import and call this early in boot.py."""
+    global _phase_timer
+
+    if _phase_timer is None:
+        _phase_timer = PhaseTimer()
+    return _phase_timer
@@ -0,0 +1,120 @@
+#! /usr/bin/env python3
+#
+# Check that a compiled deployment mirrors the source tree.
+#
+# This file is part of micropython-usmart-sensor-application.
+# https://github.com/bensherlock/micropython-usmart-sensor-application
+#
+#
+# MIT License
+#
+# Copyright (c) 2020 Benjamin Sherlock <benjamin.sherlock@ncl.ac.uk>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Check that the deploy/ tree made by makedeploy.sh mirrors the main/ source tree.
+
+Every .py below main/ must have a matching .mpy (or the .py itself) in deploy/, every .mpy must have a valid header
+with the same bytecode version, and there must be no .mpy without a source. boot.py and main.py must stay as source.
+A .py left next to its .mpy is reported too, as the board imports the .py in preference and the .mpy is never used.
+
+Usage: python3 checkdeploy.py [-s ../main] [-d ../deploy]
+"""
+
+import argparse
+import os
+import sys
+
+KEEP_AS_SOURCE = ('boot.py', 'main.py')
+
+
+def source_files(root):
+    """Relative paths of the .py files below root, skipping the .git repos."""
+    paths = set()
+    for directory, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d != '.git']
+        for filename in filenames:
+            if filename.endswith('.py'):
+                paths.add(os.path.relpath(os.path.join(directory, filename), root))
+    return paths
+
+
+def deployed_files(root):
+    """Relative paths of the .py and .mpy files below root."""
+    paths = set()
+    for directory, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.endswith('.py') or filename.endswith('.mpy'):
+                paths.add(os.path.relpath(os.path.join(directory, filename), root))
+    return paths
+
+
+def check(source_root, deploy_root):
+    """Returns a list of the problems found."""
+    problems = []
+    sources = source_files(source_root)
+    deployed = deployed_files(deploy_root)
+    mpy_versions = set()
+
+    for path in sorted(sources):
+        mpy_path = path[:-3] + '.mpy'
+        if path in KEEP_AS_SOURCE:
+            if path not in deployed:
+                problems.append('missing source: ' + path)
+            if mpy_path in deployed:
+                problems.append('must stay as source: ' + path)
+        elif mpy_path in deployed:
+            if path in deployed:
+                problems.append('source shadows mpy: ' + path)
+            with open(os.path.join(deploy_root, mpy_path), 'rb') as f:
+                header = f.read(4)
+            if len(header) < 4 or header[0:1] != b'M':
+                problems.append('bad mpy header: ' + mpy_path)
+            else:
+                mpy_versions.add(header[1])
+        elif path not in deployed:
+            problems.append('missing: ' + path)
+
+    for path in sorted(deployed):
+        if path.endswith('.mpy') and path[:-4] + '.py' not in sources:
+            problems.append('no source for: ' + path)
+
+    if len(mpy_versions) > 1:
+        problems.append('mixed mpy versions: ' + ', '.join(str(v) for v in sorted(mpy_versions)))
+
+    return problems
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Check the deploy tree mirrors the main source tree.')
+    parser.add_argument('-s', '--source', default=os.path.join(script_dir, '..', 'main'), help='source tree')
+    parser.add_argument('-d', '--deploy', default=os.path.join(script_dir, '..', 'deploy'), help='deploy tree')
+    args = parser.parse_args()
+
+    problems = check(args.source, args.deploy)
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit(1)
+    print('deploy tree OK')
+
+
+if __name__ == '__main__':
+    main()
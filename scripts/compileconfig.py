@@ -0,0 +1,77 @@
+#! /usr/bin/env python3
+#
+# Compile the JSON config files into a Python module so the board needn't parse JSON at boot.
+#
+# This file is part of micropython-usmart-sensor-application.
+# https://github.com/bensherlock/micropython-usmart-sensor-application
+#
+#
+# MIT License
+#
+# Copyright (c) 2020 Benjamin Sherlock <benjamin.sherlock@ncl.ac.uk>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Compile main/config/*.json into main/config_compiled.py, which main/configuration.py imports in their place.
+
+Usage: python3 compileconfig.py [-c ../main/config] [-o ../main/config_compiled.py]
+
+The output holds the wifi password so it is ignored by git. It can be cross compiled to .mpy like the other modules.
+"""
+
+import argparse
+import json
+import os
+import pprint
+
+MODULE_CONFIG_SUFFIX = '_gitrepo_cfg.json'
+
+
+def load_configs(config_path):
+    """Merge the config files the same way as configuration.load_json_configs() on the board."""
+    config = {'wifi': None, 'startup': None, 'modules': {}}
+    for filename in sorted(os.listdir(config_path)):
+        path = os.path.join(config_path, filename)
+        if filename.endswith(MODULE_CONFIG_SUFFIX):
+            with open(path) as f:
+                config['modules'][filename[:-len(MODULE_CONFIG_SUFFIX)]] = json.load(f)
+        elif filename in ('wifi_cfg.json', 'startup_cfg.json'):
+            with open(path) as f:
+                config[filename[:-len('_cfg.json')]] = json.load(f)
+    return config
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Compile the JSON config files into a Python module.')
+    parser.add_argument('-c', '--config', default=os.path.join(script_dir, '..', 'main', 'config'),
+                        help='config directory')
+    parser.add_argument('-o', '--output', default=os.path.join(script_dir, '..', 'main', 'config_compiled.py'),
+                        help='output module')
+    args = parser.parse_args()
+
+    config = load_configs(args.config)
+    with open(args.output, 'w') as f:
+        f.write('# Generated by scripts/compileconfig.py from the config/*.json files. Do not edit.\n')
+        f.write('CONFIG = ' + pprint.pformat(config, width=120) + '\n')
+    print('Wrote ' + args.output + ' with ' + str(len(config['modules'])) + ' module configs')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#! /usr/bin/env python3
+#
+# Decode binary Jotter logs back into the text log format.
+#
+# This file is part of micropython-usmart-sensor-application.
+# https://github.com/bensherlock/micropython-usmart-sensor-application
+#
+#
+# MIT License
+#
+# Copyright (c) 2020 Benjamin Sherlock <benjamin.sherlock@ncl.ac.uk>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Decode binary Jotter logs (/sd/logs/<name>.bin) back into the text log format.
+
+Usage: python3 decodejotter.py root.bin [root.1.bin ...] > root.log
+"""
+
+import argparse
+import struct
+import sys
+import time
+
+# Must match main/jotter.py
+RECORD_HEADER_FORMAT = '<BBIHH'
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER_FORMAT)
+RECORD_KIND_ENTRY = 0
+RECORD_KIND_SOURCE = 1
+LEVEL_EXCEPTION = 1
+
+# MicroPython on the PYBD counts seconds from 2000-01-01.
+EPOCH_OFFSET = 946684800
+
+
+def decode(infile, outfile):
+    """Decode the records from the binary infile and write them as text lines to outfile.
+    Returns the number of entries decoded."""
+    sources = {}
+    count = 0
+    while True:
+        header = infile.read(RECORD_HEADER_SIZE)
+        if len(header) < RECORD_HEADER_SIZE:
+            break
+        kind, level, seconds, source_id, length = struct.unpack(RECORD_HEADER_FORMAT, header)
+        payload = infile.read(length)
+        if len(payload) < length:
+            print('Truncated record at end of file', file=sys.stderr)
+            break
+        payload = payload.decode('utf-8', errors='replace')
+
+        if kind == RECORD_KIND_SOURCE:
+            sources[source_id] = payload
+        elif kind == RECORD_KIND_ENTRY:
+            timestamp_str = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(seconds + EPOCH_OFFSET))
+            if level == LEVEL_EXCEPTION:
+                outfile.write(timestamp_str + ' ' + payload)
+            else:
+                entry = timestamp_str + ' - '
+                if source_id:
+                    entry += sources.get(source_id, '<source %d>' % source_id) + ' - '
+                outfile.write(entry + payload + '\n')
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode binary Jotter logs into the text log format.')
+    parser.add_argument('files', nargs='+', help='binary log files, oldest first')
+    parser.add_argument('-o', '--output', help='output file (default stdout)')
+    args = parser.parse_args()
+
+    outfile = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for filename in args.files:
+            with open(filename, 'rb') as infile:
+                decode(infile, outfile)
+    finally:
+        if args.output:
+            outfile.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,623 @@
+#! /usr/bin/env python3
+#
+# Host benchmark suite for the MicroPython USMART Sensor Application.
+#
+# This file is part of micropython-usmart-sensor-application.
+# https://github.com/bensherlock/micropython-usmart-sensor-application
+#
+#
+# MIT License
+#
+# Copyright (c) 2020 Benjamin Sherlock <benjamin.sherlock@ncl.ac.uk>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Benchmarks of the boot, OTA and Jotter paths, run on the host with hostsim.py and fakegithub.py.
+
+Each benchmark is timed on a fresh sandbox, and run a second time under tracemalloc for the peak memory unless
+--no-memory is given. Times are wall time on the host with the sleeps skipped, the virtual time the board would have
+spent asleep is given as sleep_ms. Peak memory is of the CPython heap, so compare it between runs rather than with the
+MicroPython heap. The OTA benchmarks also count the requests, connections and body bytes seen by the fake server.
+
+Save a baseline with --json and compare later runs against it with --baseline to catch regressions.
+
+Usage:
+    python3 bench.py
+    python3 bench.py --only ota_install_files,ota_update_delta --latency-ms 100 --bandwidth 250000
+    python3 bench.py --json baseline.json
+    python3 bench.py --baseline baseline.json
+    python3 bench.py --only index_log --index-mb 1024
+"""
+
+import argparse
+import contextlib
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import fakegithub
+import hostsim
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import indexjotter  # noqa: E402 scripts/indexjotter.py
+import makebundle  # noqa: E402 scripts/makebundle.py
+
+# Metrics compared against the baseline. Wall time also has to grow by WALL_NOISE_MS to count.
+COMPARED_METRICS = ('wall_ms', 'requests', 'bytes', 'peak_kib')
+WALL_NOISE_MS = 5.0
+
+_benchmarks = []
+
+
+def benchmark(function):
+    """Register a benchmark, run as function(args, measure)."""
+    _benchmarks.append(function)
+    return function
+
+
+class Measure:
+    """Context manager factory that measures the block into result. Pass the server to count its traffic."""
+
+    def __init__(self, trace):
+        self.trace = trace
+        self.result = {}
+
+    @contextlib.contextmanager
+    def __call__(self, server=None):
+        if server:
+            server.stats(reset=True)
+        if self.trace:
+            tracemalloc.start()
+        sleep_start = hostsim.state.sleep_ms
+        start = time.perf_counter()
+        try:
+            yield self.result
+        finally:
+            wall_ms = (time.perf_counter() - start) * 1000
+            if self.trace:
+                self.result['peak_kib'] = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+                tracemalloc.stop()
+            else:
+                self.result['wall_ms'] = round(wall_ms, 2)
+                self.result['sleep_ms'] = hostsim.state.sleep_ms - sleep_start
+                if server:
+                    stats = server.stats()
+                    self.result['requests'] = stats['requests']
+                    self.result['connections'] = stats['connections']
+                    self.result['bytes'] = stats['bytes']
+
+
+def module_repos():
+    """Module name to owner/name of the repo, from the module configs."""
+    config_dir = os.path.join(hostsim.MAIN_DIR, 'config')
+    repos = {}
+    for filename in sorted(os.listdir(config_dir)):
+        if filename.endswith('_gitrepo_cfg.json'):
+            with open(os.path.join(config_dir, filename)) as f:
+                repos[filename[:-len('_gitrepo_cfg.json')]] = fakegithub.repo_name(json.load(f)['gitrepo']['url'])
+    return repos
+
+
+def release_files(args, module, index, changed=0):
+    """Files of a release of the module. The ota_updater repo gets the real updater so it still imports afterwards.
+    The first changed files differ from the original release."""
+    if module == 'ota_updater':
+        with open(os.path.join(hostsim.MAIN_DIR, 'ota_updater', 'main', 'ota_updater.py'), 'rb') as f:
+            files = {'main/ota_updater.py': f.read()}
+        if changed:
+            files['main/ota_updater.py'] += b'\n# changed\n'
+        return files
+    files = fakegithub.make_files(args.files, args.size, seed=index)
+    for path in sorted(files)[:changed]:
+        files[path] = b'# changed\n' + files[path]
+    return files
+
+
+def publish(server, args, tag, changed=0, asset=True):
+    for (index, (module, repo)) in enumerate(module_repos().items()):
+        server.set_release(repo, tag, release_files(args, module, index, changed),
+                           fakegithub.RELEASE_ASSET if asset else None)
+
+
+def use_release_asset(sandbox):
+    """Configure every module to update from the release asset."""
+    config_dir = os.path.join(sandbox.flash, 'config')
+    for filename in os.listdir(config_dir):
+        if filename.endswith('_gitrepo_cfg.json'):
+            path = os.path.join(config_dir, filename)
+            with open(path) as f:
+                cfg = json.load(f)
+            cfg['gitrepo']['asset'] = fakegithub.RELEASE_ASSET
+            with open(path, 'w') as f:
+                json.dump(cfg, f)
+
+
+def ota_session(main):
+    """Run one update session through to its reset."""
+    try:
+        main.download_and_install_updates_if_available()
+    except hostsim.HostReset:
+        pass
+
+
+@contextlib.contextmanager
+def without_uasyncio():
+    """As on a firmware without uasyncio streams over TLS, so the update session checks the modules one by one."""
+    saved = sys.modules.get('uasyncio')
+    sys.modules['uasyncio'] = None  # Makes the import raise ImportError.
+    try:
+        yield
+    finally:
+        sys.modules['uasyncio'] = saved
+
+
+def fake_github(args, **options):
+    settings = {'latency_ms': args.latency_ms, 'bandwidth': args.bandwidth, 'fail_rate': args.fail_rate}
+    settings.update(options)
+    return fakegithub.FakeGitHub(**settings)
+
+
+@benchmark
+def boot_scan(args, measure):
+    """Boot with no installed manifest, so the module versions are scanned."""
+    with hostsim.Sandbox(modules=module_repos()) as sandbox:
+        with measure():
+            sandbox.boot()
+
+
+@benchmark
+def boot_manifest(args, measure):
+    """Boot with the installed manifest written by the boot before."""
+    with hostsim.Sandbox(modules=module_repos()) as sandbox:
+        sandbox.boot()
+        with measure():
+            sandbox.boot()
+
+
+@benchmark
+def boot_hibernation_wake(args, measure):
+    """Waking from hibernation to find the battery still low and going back to sleep from boot.py."""
+    with hostsim.Sandbox(modules=module_repos(), powermodule=True) as sandbox:
+        hostsim.state.reset_cause = hostsim.PWRON_RESET
+        hostsim.state.vbatt = 3.5
+        sandbox.boot()  # Goes into hibernation.
+        hostsim.state.vbatt = 3.7  # Above the cutoff but not the resume voltage.
+        with measure() as result:
+            main = sandbox.boot()
+        import hibernation
+        result['wakeups'] = hibernation.get_state()[1]
+        result['main_loaded'] = main is not None
+
+
+@benchmark
+def boot_vbatt_slow_cutoff(args, measure):
+    """Boot with the battery reading settling slowly to just below the cutoff, which has to end in hibernation."""
+    with hostsim.Sandbox(modules=module_repos(), powermodule=True) as sandbox:
+        hostsim.state.vbatt = lambda ms: 3.58 + 0.62 * math.exp(-ms / 300)
+        with measure() as result:
+            sandbox.boot()
+        import hibernation
+        result['hibernated'] = hibernation.is_hibernating()
+
+
+@benchmark
+def installed_versions(args, measure):
+    """get_installed_module_versions() from the manifest, per call."""
+    with hostsim.Sandbox(modules=module_repos()) as sandbox:
+        main = sandbox.boot()
+        with measure() as result:
+            for i in range(args.repeat):
+                main.get_installed_module_versions()
+        if 'wall_ms' in result:
+            result['wall_ms'] = round(result['wall_ms'] / args.repeat, 3)
+
+
+def installed(sandbox, tag):
+    """Number of modules with the tag installed in their main directory."""
+    count = 0
+    for module in module_repos():
+        try:
+            with open(os.path.join(sandbox.flash, module, 'main', '.version')) as f:
+                count += f.read() == tag
+        except OSError:
+            pass
+    return count
+
+
+def install_files(args, measure, **options):
+    with fake_github(args, **options) as server, hostsim.Sandbox(wifi=True) as sandbox:
+        publish(server, args, 'v1')
+        hostsim.state.redirect = server.address
+        main = sandbox.boot()
+        with measure(server) as result:
+            ota_session(main)
+        result['installed'] = installed(sandbox, 'v1')
+
+
+@benchmark
+def ota_install_files(args, measure):
+    """First install of every module file by file, listed by the git trees API."""
+    install_files(args, measure)
+
+
+@benchmark
+def ota_install_files_sequential(args, measure):
+    """As ota_install_files with the release checks made one by one, without uasyncio."""
+    with without_uasyncio():
+        install_files(args, measure)
+
+
+@benchmark
+def ota_install_files_chunked(args, measure):
+    """As ota_install_files with every reply sent with chunked transfer encoding."""
+    install_files(args, measure, chunked=True)
+
+
+@benchmark
+def ota_install_contents(args, measure):
+    """First install of every module file by file, walking the contents API as before the trees listing."""
+    with fake_github(args, trees=False) as server, hostsim.Sandbox(wifi=True) as sandbox:
+        publish(server, args, 'v1')
+        hostsim.state.redirect = server.address
+        main = sandbox.boot()
+        with measure(server):
+            ota_session(main)
+
+
+def install_asset(args, measure, **options):
+    with fake_github(args, **options) as server, hostsim.Sandbox(wifi=True) as sandbox:
+        publish(server, args, 'v1')
+        use_release_asset(sandbox)
+        hostsim.state.redirect = server.address
+        main = sandbox.boot()
+        with measure(server) as result:
+            ota_session(main)
+        result['installed'] = installed(sandbox, 'v1')
+
+
+@benchmark
+def ota_install_asset(args, measure):
+    """First install of every module from its release asset."""
+    install_asset(args, measure)
+
+
+@benchmark
+def ota_install_asset_chunked(args, measure):
+    """As ota_install_asset with the release json, the redirected asset and every other reply sent chunked."""
+    install_asset(args, measure, chunked=True)
+
+
+@benchmark
+def ota_update_delta(args, measure):
+    """Update to a release with one changed file per module."""
+    with fake_github(args) as server, hostsim.Sandbox(wifi=True) as sandbox:
+        publish(server, args, 'v1')
+        hostsim.state.redirect = server.address
+        main = sandbox.boot()
+        ota_session(main)
+        publish(server, args, 'v2', changed=1)
+        with measure(server):
+            ota_session(main)
+
+
+def not_modified(args, measure):
+    with fake_github(args) as server, hostsim.Sandbox(wifi=True) as sandbox:
+        publish(server, args, 'v1')
+        hostsim.state.redirect = server.address
+        main = sandbox.boot()
+        ota_session(main)
+        with measure(server):
+            ota_session(main)
+
+
+@benchmark
+def ota_not_modified(args, measure):
+    """Update session with no new releases."""
+    not_modified(args, measure)
+
+
+@benchmark
+def ota_not_modified_sequential(args, measure):
+    """As ota_not_modified with the release checks made one by one, without uasyncio."""
+    with without_uasyncio():
+        not_modified(args, measure)
+
+
+def bundle_install(args, measure, as_directory):
+    """Install every module from an update bundle on the sandbox SD card, timing the copy throughput."""
+    with hostsim.Sandbox() as sandbox:
+        modules = {}
+        for (index, module) in enumerate(module_repos()):
+            main_dir = os.path.join(sandbox.path, 'bundle_source', module, 'main')
+            for (path, data) in release_files(args, module, index).items():
+                path = os.path.join(main_dir, path[len('main/'):])
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(data)
+            modules[module] = ('v1', main_dir)
+        makebundle.make_bundle(modules, os.path.join(sandbox.sd, 'ota'), as_directory)
+        main = sandbox.boot()
+        main.OTA_BUNDLE_DIR = os.path.join(sandbox.sd, 'ota')
+        with measure() as result:
+            try:
+                main.install_bundle_if_available()
+            except hostsim.HostReset:
+                pass
+        installed = main.OTAUpdater.load_installed_manifest() or {}
+        result['installed'] = sum(1 for module in modules if installed.get(module) == 'v1')
+        copied = sum(len(data) for (index, module) in enumerate(modules)
+                     for data in release_files(args, module, index).values())
+        result['copied'] = copied
+        if result.get('wall_ms'):
+            result['mb_per_s'] = round(copied / 1e6 / (result['wall_ms'] / 1000), 1)
+
+
+@benchmark
+def ota_bundle_tar(args, measure):
+    """First install of every module from a bundle of tars on the SD card."""
+    bundle_install(args, measure, False)
+
+
+@benchmark
+def ota_bundle_directory(args, measure):
+    """First install of every module from a bundle of directories on the SD card."""
+    bundle_install(args, measure, True)
+
+
+def download(args, measure, streamed):
+    """Download one large file, timing the throughput. Peak memory is of the download alone."""
+    with fake_github(args) as server, hostsim.Sandbox(wifi=True) as sandbox:
+        repo = 'bensherlock/micropython-usmart-sensor-mainloop'
+        files = fakegithub.make_files(1, args.download_kb * 1024)
+        (path, data), = files.items()
+        server.set_release(repo, 'v1', files, None)
+        hostsim.state.redirect = server.address
+        main = sandbox.boot()
+        o = main.OTAUpdater('https://github.com/' + repo, 'mainloop', http_client=main.HttpClient())
+        url = 'https://raw.githubusercontent.com/' + repo + '/v1/' + path
+        sha = fakegithub.git_blob_sha(data)
+        with measure(server) as result:
+            if streamed:
+                o.download_file(url, 'download.py', len(data), sha)
+            else:
+                # As download_file() was: the whole body read into memory, decoded and written out in one.
+                response = o._http_client.get(url, headers=o.get_headers())
+                with open('download.py', 'w') as outfile:
+                    outfile.write(response.text)
+                response.close()
+        if result.get('wall_ms'):
+            result['mb_per_s'] = round(len(data) / 1e6 / (result['wall_ms'] / 1000), 1)
+
+
+@benchmark
+def download_text(args, measure):
+    """Downloading a large file the old way, with response.text."""
+    download(args, measure, False)
+
+
+@benchmark
+def download_streamed(args, measure):
+    """Downloading the same file streamed through the buffer and hashed, as download_file() does."""
+    download(args, measure, True)
+
+
+def jotter_workload(args, measure, **kwargs):
+    with hostsim.Sandbox() as sandbox:
+        sandbox.boot()
+        import jotter
+        j = jotter.Jotter('bench', max_size=0, **kwargs)
+        writes = [0]
+        append = j._append
+
+        def counting_append(data):
+            writes[0] += 1
+            append(data)
+
+        j._append = counting_append
+        with measure() as result:
+            for i in range(args.jots):
+                j.jot('sensor reading %d' % i, source_file='mainloop.main.mainloop')
+            j.flush()
+        result['jots_per_s'] = round(args.jots / (result['wall_ms'] / 1000)) if result.get('wall_ms') else None
+        result['writes_per_1000_jots'] = round(writes[0] * 1000 / args.jots, 1)
+
+
+def wifi_connect(measure, connects_before, fast_reconnect=True, moved=False):
+    """Time to connect to the wifi, in virtual time as the radio is simulated. moved replaces the access point after
+    the connections before, so the cached one is gone."""
+    with hostsim.Sandbox(wifi=True) as sandbox:
+        main = sandbox.boot()
+        import network
+        wifi = main.load_wifi_config()['wifi']
+        for i in range(connects_before):
+            main.OTAUpdater.using_network(wifi['ssid'], wifi['password'], fast_reconnect=fast_reconnect)
+            network.WLAN(network.STA_IF).active(False)
+        if moved:
+            hostsim.state.wifi_bssid = b'\x02\x00\x00\x00\x00\x04'
+        with measure() as result:
+            result['connected'] = main.OTAUpdater.using_network(wifi['ssid'], wifi['password'],
+                                                                fast_reconnect=fast_reconnect)
+
+
+@benchmark
+def wifi_connect_cold(args, measure):
+    """Connecting to the wifi for the first time, scanning and waiting on DHCP."""
+    wifi_connect(measure, 0)
+
+
+@benchmark
+def wifi_connect_cached(args, measure):
+    """Reconnecting to the wifi straight to the cached access point with the cached IP configuration."""
+    wifi_connect(measure, 1)
+
+
+@benchmark
+def wifi_connect_no_cache(args, measure):
+    """Reconnecting to the wifi with fast_reconnect off, which joins by the ssid alone as it did before the cache."""
+    wifi_connect(measure, 1, fast_reconnect=False)
+
+
+@benchmark
+def wifi_connect_stale_cache(args, measure):
+    """Reconnecting to the wifi after the cached access point has gone, falling back to a scan and DHCP."""
+    wifi_connect(measure, 1, moved=True)
+
+
+@benchmark
+def jotter_text(args, measure):
+    """Jotting text entries straight to the card."""
+    jotter_workload(args, measure)
+
+
+@benchmark
+def jotter_text_buffered(args, measure):
+    """Jotting text entries through a 4 KiB buffer."""
+    jotter_workload(args, measure, buffer_size=4096)
+
+
+@benchmark
+def jotter_binary_buffered(args, measure):
+    """Jotting binary records through a 4 KiB buffer."""
+    jotter_workload(args, measure, buffer_size=4096, binary=True)
+
+
+@benchmark
+def jotter_tail(args, measure):
+    """Reading the last 20 lines of a long log."""
+    with hostsim.Sandbox() as sandbox:
+        sandbox.boot()
+        import jotter
+        j = jotter.Jotter('bench', max_size=0, buffer_size=65536)
+        for i in range(args.jots * 5):
+            j.jot('sensor reading %d' % i, source_file='mainloop.main.mainloop')
+        j.flush()
+        with measure():
+            lines = list(j.iter_tail(20))
+        assert len(lines) == 20
+
+
+@benchmark
+def index_log(args, measure):
+    """Indexing a recovered text log on the host, then querying it for exceptions."""
+    with tempfile.TemporaryDirectory() as directory:
+        log_path = os.path.join(directory, 'root.log')
+        entry = b'2021-09-01 12:00:00 - mainloop.main.mainloop - sensor reading 12345\n'
+        exception = (b'2021-09-01 12:00:01 Traceback (most recent call last):\n'
+                     b'  File "main.py", line 1, in <module>\nOSError: 5\n')
+        block = entry * 999 + exception
+        with open(log_path, 'wb') as f:
+            for i in range(args.index_mb * (1 << 20) // len(block)):
+                f.write(block)
+        with measure() as result:
+            indexjotter.get_index(log_path)
+            count = sum(1 for record in indexjotter.query(log_path, exceptions_only=True))
+        if result.get('wall_ms'):
+            result['mb_per_s'] = round(args.index_mb / (result['wall_ms'] / 1000), 1)
+        result['exceptions'] = count
+
+
+def run(args):
+    results = {}
+    names = args.only.split(',') if args.only else None
+    for function in _benchmarks:
+        if names and function.__name__ not in names:
+            continue
+        measure = Measure(trace=False)
+        function(args, measure)
+        result = measure.result
+        if not args.no_memory:
+            measure = Measure(trace=True)
+            function(args, measure)
+            result['peak_kib'] = measure.result['peak_kib']
+        results[function.__name__] = result
+        print_result(function.__name__, result)
+    return results
+
+
+def print_result(name, result):
+    line = '%-28s' % name
+    for metric in ('wall_ms', 'sleep_ms', 'requests', 'connections', 'bytes', 'peak_kib'):
+        if metric in result:
+            line += ' %s=%s' % (metric, result[metric])
+    for (metric, value) in sorted(result.items()):
+        if metric not in ('wall_ms', 'sleep_ms', 'requests', 'connections', 'bytes', 'peak_kib'):
+            line += ' %s=%s' % (metric, value)
+    print(line, flush=True)
+
+
+def compare(results, baseline, threshold):
+    """Print the metrics that have grown by more than the threshold since the baseline. Returns the count."""
+    regressions = 0
+    for (name, result) in results.items():
+        for metric in COMPARED_METRICS:
+            old = baseline.get(name, {}).get(metric)
+            new = result.get(metric)
+            if old is None or new is None:
+                continue
+            if new > old * (1 + threshold) and not (metric == 'wall_ms' and new - old < WALL_NOISE_MS):
+                print('REGRESSION %s %s: %s -> %s' % (name, metric, old, new))
+                regressions += 1
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the boot, OTA and Jotter paths on the host.')
+    parser.add_argument('--only', help='comma separated benchmark names')
+    parser.add_argument('--list', action='store_true', help='list the benchmarks')
+    parser.add_argument('--files', type=int, default=10, help='files per module release (default 10)')
+    parser.add_argument('--size', type=int, default=4096, help='bytes per file (default 4096)')
+    parser.add_argument('--download-kb', type=int, default=1024,
+                        help='size of the file for the download benchmarks (default 1024)')
+    parser.add_argument('--latency-ms', type=int, default=0, help='fake server latency per request')
+    parser.add_argument('--bandwidth', type=int, default=0, help='fake server bytes per second (default unlimited)')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='chance of a failed reply (default 0)')
+    parser.add_argument('--jots', type=int, default=20000, help='jots per Jotter benchmark (default 20000)')
+    parser.add_argument('--repeat', type=int, default=100, help='calls per installed_versions run (default 100)')
+    parser.add_argument('--index-mb', type=int, default=64,
+                        help='size of the log to index (default 64, 1024 for a season of logs on the SD card)')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass')
+    parser.add_argument('--json', help='save the results to this file')
+    parser.add_argument('--baseline', help='compare with results saved by --json')
+    parser.add_argument('--threshold', type=float, default=0.2, help='regression threshold (default 0.2)')
+    args = parser.parse_args()
+
+    if args.list:
+        for function in _benchmarks:
+            print('%-28s %s' % (function.__name__, function.__doc__))
+        return
+
+    hostsim.install()
+    results = run(args)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'options': vars(args), 'results': results}, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,397 @@
+#! /usr/bin/env python3
+#
+# Fake GitHub server for the host simulation harness.
+#
+# This file is part of micropython-usmart-sensor-application.
+# https://github.com/bensherlock/micropython-usmart-sensor-application
+#
+#
+# MIT License
+#
+# Copyright (c) 2020 Benjamin Sherlock <benjamin.sherlock@ncl.ac.uk>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Fake GitHub API, raw content and release asset server for the host harness.
+
+Serves just enough of GitHub for the OTA updater: the latest release with ETags, git trees, the contents API, raw files
+and release assets (with the redirect to the asset storage host). The host name of each request picks the part of
+GitHub it is for, so every connection can be sent to this one server.
+
+The server runs in its own process so it doesn't take time or memory from the code being measured, and has
+configurable latency, bandwidth and failure injection.
+
+Usage:
+    with FakeGitHub(latency_ms=50, bandwidth=250000) as server:
+        server.set_release('bensherlock/micropython-usmart-sensor-mainloop', 'v1', {'main/mainloop.py': b'...'})
+        hostsim.state.redirect = server.address
+        ...
+        print(server.stats())
+"""
+
+import hashlib
+import io
+import json
+import multiprocessing
+import random
+import sys
+import tarfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+RELEASE_ASSET = 'main.tar'
+
+
+def make_files(count, size, seed=0, prefix='main/'):
+    """Synthetic source files, spread over a few subdirectories."""
+    rng = random.Random(seed)
+    files = {}
+    for i in range(count):
+        line = ('value_%d = %r\n' % (i, rng.random())).encode()
+        subdirectory = 'sub%d/' % (i % 3) if i % 2 else ''
+        files[prefix + subdirectory + 'file%d.py' % i] = (line * (size // len(line) + 1))[:size]
+    return files
+
+
+def make_tar(files):
+    """Uncompressed ustar archive of the files, with the directory entries as made by tar -cf main.tar main."""
+    directories = set()
+    for path in files:
+        directory = path.rpartition('/')[0]
+        while directory:
+            directories.add(directory)
+            directory = directory.rpartition('/')[0]
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode='w', format=tarfile.USTAR_FORMAT) as tar:
+        for path in sorted(directories | set(files)):
+            info = tarfile.TarInfo(path)
+            info.mtime = 0
+            if path in directories:
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            else:
+                info.size = len(files[path])
+                tar.addfile(info, io.BytesIO(files[path]))
+    return out.getvalue()
+
+
+def git_blob_sha(data):
+    return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+
+# Sizes of the chunks of a chunked body in turn, to put the chunk boundaries at odd places in the client's buffers.
+CHUNK_SIZES = (1, 517, 1460, 4096, 2)
+
+
+class _Simulation:
+    """State of the server process."""
+
+    def __init__(self, options):
+        self.repos = {}  # owner/name to {'latest': tag, 'tags': {tag: files}, 'assets': {tag: {name: data}}}
+        self.options = {'latency_ms': 0, 'bandwidth': 0, 'fail_rate': 0.0, 'trees': True, 'chunked': False, 'seed': 0}
+        self.lock = threading.Lock()
+        self.configure(options)
+        self.reset_stats()
+
+    def configure(self, options):
+        self.options.update(options)
+        self.random = random.Random(self.options['seed'])
+
+    def reset_stats(self):
+        self.stats = {'requests': 0, 'connections': 0, 'bytes': 0, 'not_modified': 0, 'failures': 0, 'routes': {}}
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def count_route(self, route):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['routes'][route] = self.stats['routes'].get(route, 0) + 1
+
+    def failure(self):
+        """'error', 'truncate' or None for this request."""
+        with self.lock:
+            if self.options['fail_rate'] and self.random.random() < self.options['fail_rate']:
+                self.stats['failures'] += 1
+                return self.random.choice(('error', 'truncate'))
+        return None
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        """Clients dropping connections is expected, so only report anything else."""
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.sim.count('connections')
+
+    def do_GET(self):
+        sim = self.server.sim
+        latency_ms = sim.options['latency_ms']
+        if latency_ms:
+            time.sleep(latency_ms / 1000)
+
+        url = urlsplit(self.path)
+        host = self.headers.get('Host', '').split(':')[0]
+        parts = [p for p in url.path.split('/') if p]
+        query = parse_qs(url.query)
+        if host == 'api.github.com' and len(parts) >= 4 and parts[0] == 'repos':
+            self._api(parts[1] + '/' + parts[2], parts[3:], query)
+        elif host == 'raw.githubusercontent.com' and len(parts) >= 4:
+            sim.count_route('raw')
+            files = self._repo(parts[0] + '/' + parts[1])['tags'].get(parts[2], {})
+            self._send_data(files.get('/'.join(parts[3:])))
+        elif host == 'objects.githubusercontent.com' and len(parts) >= 4:
+            sim.count_route('asset')
+            assets = self._repo(parts[0] + '/' + parts[1])['assets'].get(parts[2], {})
+            self._send_data(assets.get(parts[3]))
+        else:
+            sim.count_route('unknown')
+            self._send(404, b'{"message": "Not Found"}')
+
+    def _repo(self, name):
+        return self.server.sim.repos.get(name, {'latest': None, 'tags': {}, 'assets': {}})
+
+    def _api(self, name, rest, query):
+        sim = self.server.sim
+        repo = self._repo(name)
+        if rest == ['releases', 'latest']:
+            sim.count_route('release')
+            tag = repo['latest']
+            if not tag:
+                return self._send(404, b'{"message": "Not Found"}')
+            assets = repo['assets'].get(tag, {})
+            etag = '"' + hashlib.sha1((name + tag + ','.join(sorted(assets))).encode()).hexdigest()[:20] + '"'
+            if self.headers.get('If-None-Match') == etag:
+                sim.count('not_modified')
+                return self._send(304, b'', {'ETag': etag})
+            release = {'tag_name': tag, 'assets': [
+                {'name': asset_name, 'size': len(data),
+                 'url': 'https://api.github.com/repos/' + name + '/releases/assets/' + tag + '/' + asset_name,
+                 'digest': 'sha256:' + hashlib.sha256(data).hexdigest()}
+                for (asset_name, data) in sorted(assets.items())]}
+            return self._send_json(release, {'ETag': etag})
+
+        if rest[:2] == ['git', 'trees'] and len(rest) == 3:
+            sim.count_route('tree')
+            files = repo['tags'].get(rest[2])
+            if files is None or not sim.options['trees']:
+                return self._send(404, b'{"message": "Not Found"}')
+            entries = {}
+            for (path, data) in files.items():
+                directory = path.rpartition('/')[0]
+                while directory and directory not in entries:
+                    entries[directory] = {'path': directory, 'type': 'tree', 'mode': '040000'}
+                    directory = directory.rpartition('/')[0]
+                entries[path] = {'path': path, 'type': 'blob', 'mode': '100644', 'sha': git_blob_sha(data),
+                                 'size': len(data)}
+            return self._send_json({'tree': [entries[path] for path in sorted(entries)], 'truncated': False})
+
+        if rest[:1] == ['contents']:
+            sim.count_route('contents')
+            tag = query.get('ref', ['refs/tags/' + str(repo['latest'])])[0].replace('refs/tags/', '')
+            files = repo['tags'].get(tag)
+            if files is None:
+                return self._send(404, b'{"message": "Not Found"}')
+            directory = '/'.join(rest[1:])
+            listing = {}
+            for (path, data) in files.items():
+                if not path.startswith(directory + '/'):
+                    continue
+                child = path[len(directory) + 1:].split('/')[0]
+                child_path = directory + '/' + child
+                if child_path == path:
+                    listing[child] = {'type': 'file', 'name': child, 'path': path, 'size': len(data),
+                                      'sha': git_blob_sha(data),
+                                      'download_url': 'https://raw.githubusercontent.com/' + name + '/refs/tags/'
+                                                      + tag + '/' + path}
+                else:
+                    listing[child] = {'type': 'dir', 'name': child, 'path': child_path}
+            return self._send_json([listing[child] for child in sorted(listing)])
+
+        if rest[:2] == ['releases', 'assets'] and len(rest) == 4:
+            sim.count_route('asset_redirect')
+            location = 'https://objects.githubusercontent.com/' + name + '/' + rest[2] + '/' + rest[3]
+            return self._send(302, b'', {'Location': location})
+
+        sim.count_route('unknown')
+        self._send(404, b'{"message": "Not Found"}')
+
+    def _send_json(self, obj, headers=None):
+        self._send(200, json.dumps(obj).encode(), headers, 'application/json')
+
+    def _send_data(self, data):
+        if data is None:
+            return self._send(404, b'404: Not Found')
+        self._send(200, data, None, 'application/octet-stream')
+
+    def _send(self, status, body, headers=None, content_type=None):
+        sim = self.server.sim
+        failure = sim.failure() if status == 200 else None
+        if failure == 'error':
+            status, body, headers = 500, b'{"message": "Server Error"}', None
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        for (k, v) in (headers or {}).items():
+            self.send_header(k, v)
+        chunked = sim.options['chunked'] and status == 200
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if failure == 'truncate':
+            body = body[:len(body) // 2]
+            self.close_connection = True
+        if chunked:
+            self._write_chunks(body, failure != 'truncate')
+        else:
+            self._write_body(body)
+
+    def _write_chunks(self, body, complete=True):
+        """Write the body in chunks of uneven sizes, some with an extension, then the last chunk and a trailer."""
+        i = 0
+        n = 0
+        while i < len(body):
+            size = CHUNK_SIZES[n % len(CHUNK_SIZES)]
+            piece = body[i:i + size]
+            self.wfile.write(b'%x%s\r\n' % (len(piece), b';n=%d' % n if n % 3 == 2 else b''))
+            self._write_body(piece)
+            self.wfile.write(b'\r\n')
+            i += size
+            n += 1
+        if complete:
+            self.wfile.write(b'0\r\nX-Trailer: done\r\n\r\n')
+
+    def _write_body(self, body):
+        """Write the body no faster than the configured bandwidth in bytes per second."""
+        sim = self.server.sim
+        bandwidth = sim.options['bandwidth']
+        step = 1460 if bandwidth else max(len(body), 1)
+        for i in range(0, len(body), step):
+            piece = body[i:i + step]
+            self.wfile.write(piece)
+            sim.count('bytes', len(piece))  # As it goes, so the stats are right as soon as the client has the body.
+            if bandwidth:
+                time.sleep(len(piece) / bandwidth)
+
+
+def _serve(conn, options):
+    """Server process. Takes commands from the connection until told to stop."""
+    server = _Server(('127.0.0.1', 0), _Handler)
+    server.sim = _Simulation(options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    conn.send(server.server_address)
+    sim = server.sim
+    while True:
+        command, args = conn.recv()
+        if command == 'stop':
+            break
+        with sim.lock:
+            if command == 'release':
+                name, tag, files, assets = args
+                repo = sim.repos.setdefault(name, {'latest': None, 'tags': {}, 'assets': {}})
+                repo['latest'] = tag
+                repo['tags'][tag] = files
+                repo['assets'][tag] = assets
+                conn.send(None)
+            elif command == 'configure':
+                sim.configure(args)
+                conn.send(None)
+            elif command == 'stats':
+                conn.send(json.loads(json.dumps(sim.stats)))
+                if args:
+                    sim.reset_stats()
+    server.shutdown()
+    conn.send(None)
+
+
+class FakeGitHub:
+    """Runs the fake GitHub server in a separate process.
+    latency_ms delays each request, bandwidth limits the body rate in bytes per second (0 for unlimited) and
+    fail_rate is the chance of a 500 or a truncated body for each successful reply. trees=False makes the git trees
+    API unavailable so the updater falls back to the contents API. chunked sends every successful reply with
+    Transfer-Encoding: chunked rather than a Content-Length."""
+
+    def __init__(self, latency_ms=0, bandwidth=0, fail_rate=0.0, trees=True, chunked=False, seed=0):
+        self._options = {'latency_ms': latency_ms, 'bandwidth': bandwidth, 'fail_rate': fail_rate, 'trees': trees,
+                         'chunked': chunked, 'seed': seed}
+        self._conn = None
+        self._process = None
+        self.address = None
+
+    def start(self):
+        self._conn, child_conn = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_serve, args=(child_conn, self._options), daemon=True)
+        self._process.start()
+        self.address = tuple(self._conn.recv())
+        return self.address
+
+    def stop(self):
+        if self._process:
+            self._conn.send(('stop', None))
+            self._conn.recv()
+            self._process.join()
+            self._process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def _call(self, command, args):
+        self._conn.send((command, args))
+        return self._conn.recv()
+
+    def set_release(self, repo, tag, files, asset=RELEASE_ASSET):
+        """Publish files (path in the repo to contents) as the latest release tag of the repo, e.g. 'owner/name'.
+        Also attached as a tar release asset unless asset is None."""
+        self._call('release', (repo, tag, files, {asset: make_tar(files)} if asset else {}))
+
+    def configure(self, **options):
+        """Change the latency_ms, bandwidth, fail_rate, trees or chunked options."""
+        self._call('configure', options)
+
+    def stats(self, reset=False):
+        """Counts of requests (in total and by route), connections, body bytes, 304 replies and injected failures."""
+        return self._call('stats', reset)
+
+
+def repo_name(url):
+    """owner/name of a https://github.com/owner/name url."""
+    return '/'.join(url.rstrip('/').split('/')[-2:])
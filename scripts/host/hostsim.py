@@ -0,0 +1,694 @@
+#! /usr/bin/env python3
+#
+# Host simulation harness for the MicroPython USMART Sensor Application.
+#
+# This file is part of micropython-usmart-sensor-application.
+# https://github.com/bensherlock/micropython-usmart-sensor-application
+#
+#
+# MIT License
+#
+# Copyright (c) 2020 Benjamin Sherlock <benjamin.sherlock@ncl.ac.uk>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Run the application code on CPython for profiling and load testing off the board.
+
+Stand-ins are registered for the MicroPython modules the application imports (pyb, machine, utime, usocket, ussl,
+network, uasyncio and the u-prefixed standard modules). A Sandbox copies the main directory to a temporary directory
+that plays the part of the flash, with the SD card alongside it, and makes it the working directory.
+
+Sleeps don't wait. utime.sleep_ms(), machine.lightsleep() and the like move a virtual clock on instead, so a run is
+timed by the work it does, and the time that would have been spent asleep is added up in sleep_ms.
+machine.reset() and machine.deepsleep() raise HostReset, which isn't an Exception so it gets out of the application's
+exception handlers.
+
+Sockets are real. Any host name resolves to the address set with redirect() and TLS is left off, so the application
+talks to the fake GitHub server in fakegithub.py.
+
+Usage:
+    import hostsim
+    hostsim.install()
+    with hostsim.Sandbox(wifi=True) as sandbox:
+        main = sandbox.boot()  # Runs boot.py and then main.py as on the board.
+"""
+
+import asyncio
+import binascii
+import collections
+import hashlib
+import io
+import json
+import os
+import random
+import runpy
+import shutil
+import socket
+import ssl as _ssl
+import struct
+import sys
+import tempfile
+import time
+import traceback
+import types
+
+EPOCH_OFFSET = 946684800  # MicroPython's epoch is 2000-01-01.
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+MAIN_DIR = os.path.join(ROOT_DIR, 'main')
+
+# The application modules that are loaded fresh in each Sandbox.
+APP_MODULES = ('main', 'jotter', 'phasetimer', 'configuration', 'config_compiled', 'otatrial', 'hibernation', 'battery')
+
+# Reset causes as numbered by the stm32 port.
+PWRON_RESET = 1
+HARD_RESET = 2
+WDT_RESET = 3
+DEEPSLEEP_RESET = 4
+SOFT_RESET = 5
+
+
+class HostReset(BaseException):
+    """Raised by machine.reset() and machine.deepsleep() in place of resetting."""
+
+
+class _State:
+    """Everything the stand-ins share, reset by each Sandbox."""
+
+    def __init__(self):
+        self.sleep_ms = 0  # Virtual time spent asleep.
+        self.reset_cause = PWRON_RESET
+        self.redirect = None  # (host, port) every connection goes to.
+        self.usb_connected = False  # A host has the USB serial port open.
+        self.usb_powered = False  # Power on USB_VBUS, which is the case whenever usb_connected is too.
+        self.vbatt = 4.0  # Or a function of sleep_ms, for a reading that settles.
+        # Wifi timings. Making the interface active powers up the radio, a connect without the access point and
+        # channel scans first, and DHCP is skipped with a static IP configuration. Connecting to any other bssid than
+        # wifi_bssid never succeeds.
+        self.wifi_power_up_ms = 500
+        self.wifi_scan_ms = 1500
+        self.wifi_join_ms = 300
+        self.wifi_dhcp_ms = 1200
+        self.wifi_bssid = b'\x02\x00\x00\x00\x00\x02'
+        self.wifi_channel = 6
+        self.wdt_feeds = 0
+        self.resets = 0
+        self.backup_registers = {}  # RTC backup register address to value, kept through deepsleep.
+
+
+state = _State()
+
+
+# utime
+
+def _ticks_ms():
+    return int(time.monotonic() * 1000) + state.sleep_ms
+
+
+def _ticks_us():
+    return int(time.monotonic() * 1000000) + state.sleep_ms * 1000
+
+
+def _sleep_ms(ms):
+    state.sleep_ms += int(ms)
+
+
+def _time():
+    return int(time.time() + state.sleep_ms / 1000) - EPOCH_OFFSET
+
+
+def _localtime(secs=None):
+    if secs is None:
+        secs = _time()
+    return tuple(time.gmtime(secs + EPOCH_OFFSET))[:8]
+
+
+def _make_utime():
+    m = types.ModuleType('utime')
+    m.ticks_ms = _ticks_ms
+    m.ticks_us = _ticks_us
+    m.ticks_cpu = _ticks_us
+    m.ticks_diff = lambda a, b: a - b
+    m.ticks_add = lambda a, b: a + b
+    m.sleep_ms = _sleep_ms
+    m.sleep_us = lambda us: _sleep_ms(us // 1000)
+    m.sleep = lambda s: _sleep_ms(s * 1000)
+    m.time = _time
+    m.localtime = _localtime
+    m.gmtime = _localtime
+    m.mktime = lambda t: int(time.mktime(tuple(t[:6]) + (0, 0, 0)) - time.timezone) - EPOCH_OFFSET
+    return m
+
+
+# machine
+
+class _WDT:
+    def __init__(self, id=0, timeout=5000):
+        self.timeout = timeout
+
+    def feed(self):
+        state.wdt_feeds += 1
+
+
+class _Timer:
+    """Soft timer. Never fires on its own, as the application doesn't yield to it on the host."""
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=-1, mode=1, period=-1, callback=None, **kwargs):
+        self.callback = callback
+
+    def init(self, **kwargs):
+        self.callback = kwargs.get('callback', self.callback)
+
+    def deinit(self):
+        self.callback = None
+
+
+def _reset():
+    state.resets += 1
+    raise HostReset('reset')
+
+
+def _deepsleep(time_ms=None):
+    if time_ms:
+        _sleep_ms(time_ms)
+    state.reset_cause = DEEPSLEEP_RESET
+    raise HostReset('deepsleep')
+
+
+def _make_machine():
+    m = types.ModuleType('machine')
+    m.PWRON_RESET = PWRON_RESET
+    m.HARD_RESET = HARD_RESET
+    m.WDT_RESET = WDT_RESET
+    m.DEEPSLEEP_RESET = DEEPSLEEP_RESET
+    m.SOFT_RESET = SOFT_RESET
+    m.reset_cause = lambda: state.reset_cause
+    m.reset = _reset
+    m.soft_reset = _reset
+    m.lightsleep = lambda time_ms=None: _sleep_ms(time_ms if time_ms else 1000)
+    m.deepsleep = _deepsleep
+    m.idle = lambda: None
+    m.freq = lambda *args: 168000000
+    m.unique_id = lambda: b'\x00host\x00'
+    m.WDT = _WDT
+    m.Timer = _Timer
+    m.Pin = _Pin
+    return m
+
+
+# pyb
+
+class _Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+
+    def __init__(self, id, mode=0, pull=None, value=None):
+        self._id = id
+        self._value = value or 0
+
+    def init(self, *args, **kwargs):
+        pass
+
+    def value(self, v=None):
+        if v is None:
+            if self._id == 'USB_VBUS':
+                return int(state.usb_powered or state.usb_connected)
+            return self._value
+        self._value = v
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def high(self):
+        self._value = 1
+
+    def low(self):
+        self._value = 0
+
+
+class _Board:
+    """pyb.Pin.board, the named pins."""
+
+    def __getattr__(self, name):
+        return _Pin(name)
+
+
+_Pin.board = _Board()
+
+
+class _LED:
+    def __init__(self, n):
+        self._on = False
+
+    def on(self):
+        self._on = True
+
+    def off(self):
+        self._on = False
+
+    def toggle(self):
+        self._on = not self._on
+
+
+class _USB_VCP:
+    def isconnected(self):
+        return state.usb_connected
+
+
+class _ADC:
+    def __init__(self, pin):
+        self._rng = random.Random(0)
+
+    def read(self):
+        # Vbatt through the powermodule's divider, with a little noise.
+        vbatt = state.vbatt(state.sleep_ms) if callable(state.vbatt) else state.vbatt
+        return int(vbatt * 4095 / 6.6 + self._rng.randint(-4, 4))
+
+
+class _RTC:
+    def datetime(self, dt=None):
+        if dt is None:
+            t = _localtime()
+            return (t[0], t[1], t[2], t[6] + 1, t[3], t[4], t[5], 0)
+
+    def wakeup(self, *args, **kwargs):
+        pass
+
+
+class _SDCard:
+    def present(self):
+        return True
+
+
+# stm
+
+class _Mem32:
+    """Word access to the RTC backup registers, which is all the application uses stm.mem32 for."""
+
+    def __getitem__(self, address):
+        return state.backup_registers.get(address, 0)
+
+    def __setitem__(self, address, value):
+        state.backup_registers[address] = value & 0xFFFFFFFF
+
+
+def _make_stm():
+    m = types.ModuleType('stm')
+    m.RTC = 0x40002800
+    m.RTC_BKP0R = 0x50
+    m.mem32 = _Mem32()
+    return m
+
+
+def _make_pyb():
+    m = types.ModuleType('pyb')
+    m.Pin = _Pin
+    m.LED = _LED
+    m.USB_VCP = _USB_VCP
+    m.ADC = _ADC
+    m.RTC = _RTC
+    m.SDCard = _SDCard
+    m.Flash = object
+    m.usb_mode = lambda *args, **kwargs: None
+    m.country = lambda *args: None
+    m.main = lambda filename: None
+    m.delay = _sleep_ms
+    m.millis = _ticks_ms
+    m.elapsed_millis = lambda start: _ticks_ms() - start
+    m.wfi = lambda: None
+    return m
+
+
+# network
+
+class _WLAN:
+    _instance = None
+
+    def __new__(cls, interface=0):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+            cls._instance._active = False
+            cls._instance._connect_at = None
+            cls._instance._static = False
+            cls._instance._config = {'antenna': 0, 'mac': b'\x02\x00\x00\x00\x00\x01', 'channel': 0}
+            cls._instance._ifconfig = ('0.0.0.0', '0.0.0.0', '0.0.0.0', '0.0.0.0')
+        return cls._instance
+
+    def active(self, is_active=None):
+        if is_active is None:
+            return self._active
+        if is_active and not self._active:
+            _sleep_ms(state.wifi_power_up_ms)
+        self._active = is_active
+        if not is_active:
+            self._connect_at = None
+            self._static = False
+
+    def deinit(self):
+        self.active(False)
+
+    def config(self, *args, **kwargs):
+        if args:
+            return self._config[args[0]]
+        self._config.update(kwargs)
+
+    def connect(self, ssid=None, key=None, bssid=None, channel=None, **kwargs):
+        if bssid is not None and bssid != state.wifi_bssid:
+            self._connect_at = -1  # Joining for ever.
+            return
+        delay_ms = state.wifi_join_ms
+        if bssid is None or channel is None:
+            delay_ms += state.wifi_scan_ms
+        if not self._static:
+            delay_ms += state.wifi_dhcp_ms
+            self._ifconfig = ('192.168.0.42', '255.255.255.0', '192.168.0.1', '192.168.0.1')
+        self._config['channel'] = state.wifi_channel
+        self._connect_at = _ticks_ms() + delay_ms
+
+    def disconnect(self):
+        self._connect_at = None
+
+    def isconnected(self):
+        return self._connect_at is not None and 0 <= self._connect_at <= _ticks_ms()
+
+    def status(self, *args):
+        if self._connect_at is None:
+            return 0
+        return 3 if self.isconnected() else 1
+
+    def ifconfig(self, config=None):
+        if config is None:
+            return self._ifconfig
+        if config == 'dhcp' and not self.isconnected():
+            # As on the lwIP ports, waits for a lease, which can't come before the interface is associated.
+            _sleep_ms(10000)
+            raise OSError(110, 'ETIMEDOUT')
+        self._static = config != 'dhcp'
+        if self._static:
+            self._ifconfig = tuple(config)
+
+    def scan(self):
+        _sleep_ms(state.wifi_scan_ms)
+        return [(b'THE_SSID', state.wifi_bssid, state.wifi_channel, -60, 3, False),
+                (b'OTHER_SSID', b'\x02\x00\x00\x00\x00\x03', 11, -50, 3, False)]
+
+
+def _make_network():
+    m = types.ModuleType('network')
+    m.STA_IF = 0
+    m.AP_IF = 1
+    m.WLAN = _WLAN
+    return m
+
+
+# usocket and ussl
+
+class _Socket:
+    """Blocking socket with the stream methods of a MicroPython socket."""
+
+    def __init__(self, af=socket.AF_INET, type=socket.SOCK_STREAM, proto=0):
+        self._s = socket.socket(af, type, proto)
+        self._f = None
+
+    def settimeout(self, t):
+        self._s.settimeout(t)
+
+    def setsockopt(self, *args):
+        self._s.setsockopt(*args)
+
+    def connect(self, address):
+        self._s.connect(address)
+        self._s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Each write is flushed as on the board.
+        self._f = self._s.makefile('rwb')
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self._f.write(data)
+        self._f.flush()
+        return len(data)
+
+    send = write
+
+    def readline(self):
+        return self._f.readline()
+
+    def read(self, n=-1):
+        return self._f.read() if n is None or n < 0 else self._f.read(n)
+
+    def readinto(self, buf, nbytes=None):
+        if nbytes is not None:
+            buf = memoryview(buf)[:nbytes]
+        return self._f.readinto1(buf)
+
+    def close(self):
+        try:
+            if self._f:
+                self._f.close()
+        except OSError:
+            pass
+        self._s.close()
+
+
+def _getaddrinfo(host, port, af=0, type=0, proto=0, flags=0):
+    if state.redirect:
+        host, port = state.redirect
+    return [(socket.AF_INET, socket.SOCK_STREAM, 0, '', (socket.gethostbyname(host), port))]
+
+
+def _make_usocket():
+    m = types.ModuleType('usocket')
+    m.AF_INET = socket.AF_INET
+    m.SOCK_STREAM = socket.SOCK_STREAM
+    m.getaddrinfo = _getaddrinfo
+    m.socket = _Socket
+    return m
+
+
+def _make_ussl():
+    m = types.ModuleType('ussl')
+    m.wrap_socket = lambda s, **kwargs: s  # The fake server speaks plain HTTP.
+    return m
+
+
+# uasyncio
+
+async def _open_connection(host, port, ssl=None, server_hostname=None):
+    # From MicroPython v1.21 ssl=True makes a PROTOCOL_TLS_CLIENT context, which verifies the server certificate, and
+    # the application loads no CA certificates, so the handshake only gets through with verification turned off.
+    if ssl is True or (ssl and ssl.verify_mode != _ssl.CERT_NONE):
+        raise OSError(-0x2700, 'certificate verify failed')  # MBEDTLS_ERR_X509_CERT_VERIFY_FAILED
+    if state.redirect:
+        host, port = state.redirect
+    return await asyncio.open_connection(host, port)
+
+
+def _make_uasyncio():
+    m = types.ModuleType('uasyncio')
+    m.run = asyncio.run
+    m.create_task = asyncio.create_task
+    m.gather = asyncio.gather
+    m.sleep = asyncio.sleep
+    m.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+    m.wait_for = asyncio.wait_for
+    m.wait_for_ms = lambda aw, ms: asyncio.wait_for(aw, ms / 1000)
+    m.Event = asyncio.Event
+    m.Lock = asyncio.Lock
+    m.CancelledError = asyncio.CancelledError
+    m.open_connection = _open_connection
+    return m
+
+
+def _make_micropython():
+    m = types.ModuleType('micropython')
+    m.const = lambda x: x
+    m.schedule = lambda f, arg: f(arg)
+    m.alloc_emergency_exception_buf = lambda size: None
+    m.mem_info = lambda *args: None
+    return m
+
+
+def _alias(name, module, **extra):
+    m = types.ModuleType(name)
+    m.__dict__.update({k: v for (k, v) in module.__dict__.items() if not k.startswith('__')})
+    m.__dict__.update(extra)
+    return m
+
+
+def _ilistdir(path='.'):
+    for entry in os.scandir(path):
+        yield (entry.name, 0x4000 if entry.is_dir() else 0x8000, 0, 0 if entry.is_dir() else entry.stat().st_size)
+
+
+def _print_exception(e, file=None):
+    traceback.print_exception(type(e), e, e.__traceback__, file=file if file else sys.stdout)
+
+
+def install():
+    """Register the stand-in modules and the MicroPython additions to os and sys."""
+    sys.modules.update({
+        'utime': _make_utime(),
+        'machine': _make_machine(),
+        'pyb': _make_pyb(),
+        'network': _make_network(),
+        'usocket': _make_usocket(),
+        'ussl': _make_ussl(),
+        'uasyncio': _make_uasyncio(),
+        'micropython': _make_micropython(),
+        'stm': _make_stm(),
+        'ujson': _alias('ujson', json),
+        'uio': _alias('uio', io),
+        'ustruct': _alias('ustruct', struct),
+        'uhashlib': _alias('uhashlib', hashlib),
+        'ubinascii': _alias('ubinascii', binascii),
+        'ucollections': _alias('ucollections', collections),
+        'uos': _alias('uos', os, ilistdir=_ilistdir),
+    })
+    os.ilistdir = _ilistdir
+    os.mount = lambda *args, **kwargs: None
+    sys.print_exception = _print_exception
+
+
+# Stand-in for the powermodule of the pybd_expansion module, written into the sandbox when it has no real one.
+POWERMODULE_SOURCE = """import pyb
+
+
+class PowerModule:
+
+    def __init__(self):
+        self._adc = pyb.ADC('X11')
+
+    def get_vbatt_reading(self):
+        return self._adc.read() * 6.6 / 4095
+
+    def enable_nm3(self):
+        pass
+
+    def disable_nm3(self):
+        pass
+"""
+
+
+class Sandbox:
+    """A fresh copy of the flash and an empty SD card in a temporary directory, made the working directory.
+    modules is a list of module names to give an installed main/.version, as if they had been updated before.
+    wifi writes a config/wifi_cfg.json. powermodule adds a stand-in for pybd_expansion.main.powermodule that reads
+    state.vbatt. Keyword arguments are set on the shared state, e.g. reset_cause."""
+
+    def __init__(self, modules=(), version='v0', wifi=False, powermodule=False, quiet=True, **kwargs):
+        self._modules = modules
+        self._powermodule = powermodule
+        self._version = version
+        self._wifi = wifi
+        self._quiet = quiet
+        self._kwargs = kwargs
+        self.path = None
+        self.flash = None
+        self.sd = None
+
+    def __enter__(self):
+        state.__init__()
+        state.__dict__.update(self._kwargs)
+        _WLAN._instance = None
+
+        self.path = tempfile.mkdtemp(prefix='hostsim-')
+        self.flash = os.path.join(self.path, 'flash')
+        self.sd = os.path.join(self.path, 'sd')
+        shutil.copytree(MAIN_DIR, self.flash, ignore=shutil.ignore_patterns('__pycache__', 'config_compiled.py'))
+        os.makedirs(os.path.join(self.sd, 'logs'))
+        if self._wifi:
+            with open(os.path.join(self.flash, 'config', 'wifi_cfg.json'), 'w') as f:
+                json.dump({'wifi': {'ssid': 'THE_SSID', 'password': 'THE_PASSWORD'}}, f)
+        powermodule_path = os.path.join(self.flash, 'pybd_expansion', 'main', 'powermodule.py')
+        if self._powermodule and not os.path.exists(powermodule_path):
+            os.makedirs(os.path.dirname(powermodule_path), exist_ok=True)
+            with open(powermodule_path, 'w') as f:
+                f.write(POWERMODULE_SOURCE)
+        for module in self._modules:
+            os.makedirs(os.path.join(self.flash, module, 'main'), exist_ok=True)
+            with open(os.path.join(self.flash, module, 'main', '.version'), 'w') as f:
+                f.write(self._version)
+
+        self._cwd = os.getcwd()
+        os.chdir(self.flash)
+        sys.path.insert(0, self.flash)
+        self._purge()
+        self._patch_jotter()
+        if self._quiet:
+            self._stdout = sys.stdout
+            sys.stdout = io.StringIO()
+        return self
+
+    def __exit__(self, *exc):
+        if self._quiet:
+            sys.stdout = self._stdout
+        self._purge()
+        sys.path.remove(self.flash)
+        os.chdir(self._cwd)
+        shutil.rmtree(self.path, ignore_errors=True)
+        return False
+
+    def boot(self):
+        """Run boot.py and then import main.py afresh, which runs boot() as on the board. Returns the main module, or
+        None if boot.py went back into deepsleep or reset before main.py. A reset ends the boot early and is left to the
+        caller to see in state.resets."""
+        self._purge()
+        self._patch_jotter()
+        try:
+            runpy.run_path(os.path.join(self.flash, 'boot.py'), run_name='boot')
+            import main
+        except HostReset:
+            pass
+        return sys.modules.get('main')
+
+    def output(self):
+        """What the application has printed so far when quiet."""
+        return sys.stdout.getvalue() if self._quiet else ''
+
+    def _purge(self):
+        """Forget the application modules so they are imported afresh from this flash."""
+        for name in list(sys.modules):
+            top = name.split('.')[0]
+            if top in APP_MODULES or os.path.isdir(os.path.join(MAIN_DIR, top)):
+                del sys.modules[name]
+
+    def _patch_jotter(self):
+        """Point the jotters at the sandbox SD card rather than /sd."""
+        import jotter
+        sd = self.sd
+        original_init = jotter.Jotter.__init__
+
+        def __init__(self, name, *args, **kwargs):
+            original_init(self, name, *args, **kwargs)
+            self._logs_path = os.path.join(sd, 'logs')
+            self._filename = os.path.join(self._logs_path, name + self._extension)
+            try:
+                self._size = os.stat(self._filename).st_size
+            except OSError:
+                self._size = 0
+
+        jotter.Jotter.__init__ = __init__
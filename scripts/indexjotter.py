@@ -0,0 +1,224 @@
+#! /usr/bin/env python3
+#
+# Index and query text Jotter logs recovered from the sensor node SD cards.
+#
+# This file is part of micropython-usmart-sensor-application.
+# https://github.com/bensherlock/micropython-usmart-sensor-application
+#
+#
+# MIT License
+#
+# Copyright (c) 2020 Benjamin Sherlock <benjamin.sherlock@ncl.ac.uk>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Index and query text Jotter logs (/sd/logs/<name>.log) recovered from the nodes.
+
+A sidecar <log>.idx is built in one streaming pass over the memory mapped log. It splits the log into blocks of about
+1 MiB on record boundaries and keeps the time range, the sources seen and the exception record offsets of each block.
+Queries then only read the blocks that can match. An index is extended rather than rebuilt when the log has grown.
+
+Usage:
+    python3 indexjotter.py index node*/logs/*.log
+    python3 indexjotter.py query node*/logs/root.log --since "2021-09-01 00:00:00" --until "2021-09-02 00:00:00"
+    python3 indexjotter.py query node*/logs/root.log --source mainloop.main.mainloop
+    python3 indexjotter.py query node*/logs/root.log --exceptions
+"""
+
+import argparse
+import json
+import mmap
+import os
+import re
+import sys
+
+INDEX_VERSION = 1
+BLOCK_SIZE = 1 << 20
+
+# Every record starts with a timestamp at the start of a line. Entries follow it with ' - ', exceptions with ' '
+# and the traceback. Lines without a timestamp continue the record before them.
+_RECORD_RE = re.compile(rb'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)( - )?', re.M)
+
+
+def _record_source(mm, match):
+    """Source file of an entry record or None. Entries without a source can't be told apart from it."""
+    if not match.group(2):
+        return None
+    line_end = mm.find(b'\n', match.end())
+    if line_end < 0:
+        line_end = len(mm)
+    separator = mm.find(b' - ', match.end(), line_end)
+    if separator < 0:
+        return None
+    return mm[match.end():separator].decode('utf-8', errors='replace')
+
+
+def _index_block(mm, start, source_ids):
+    """Index the records from start until the first record starting at least BLOCK_SIZE later.
+    Returns the block entry [start, end, min_ts, max_ts, [source ids], [exception offsets]]."""
+    end = len(mm)
+    min_ts = None
+    max_ts = None
+    sources = set()
+    exceptions = []
+    for match in _RECORD_RE.finditer(mm, start):
+        if match.start() >= start + BLOCK_SIZE:
+            end = match.start()
+            break
+        ts = match.group(1).decode('ascii')
+        if min_ts is None or ts < min_ts:
+            min_ts = ts
+        if max_ts is None or ts > max_ts:
+            max_ts = ts
+        if match.group(2):
+            source = _record_source(mm, match)
+            if source is not None:
+                sources.add(source_ids.setdefault(source, len(source_ids)))
+        else:
+            exceptions.append(match.start())
+    return [start, end, min_ts, max_ts, sorted(sources), exceptions]
+
+
+def index_path(log_path):
+    return log_path + '.idx'
+
+
+def load_index(log_path):
+    """Load the sidecar index. Returns None if there isn't a usable one."""
+    try:
+        with open(index_path(log_path)) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get('version') != INDEX_VERSION or index.get('block_size') != BLOCK_SIZE:
+        return None
+    return index
+
+
+def build_index(log_path, index=None):
+    """Build the index for the log, or bring an existing index up to date if the log has grown since."""
+    size = os.path.getsize(log_path)
+    if index is None or index['log_size'] > size:
+        index = {'version': INDEX_VERSION, 'block_size': BLOCK_SIZE, 'log_size': 0, 'sources': [], 'blocks': []}
+    if index['log_size'] == size:
+        return index
+
+    source_ids = {name: i for i, name in enumerate(index['sources'])}
+    blocks = index['blocks']
+    start = 0
+    if blocks:
+        # The last block may have been partial, so index it again along with the new data.
+        start = blocks.pop()[0]
+
+    if size:
+        with open(log_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            while start < size:
+                block = _index_block(mm, start, source_ids)
+                blocks.append(block)
+                start = block[1]
+
+    index['log_size'] = size
+    index['sources'] = [name for name, i in sorted(source_ids.items(), key=lambda item: item[1])]
+    with open(index_path(log_path), 'w') as f:
+        json.dump(index, f)
+    return index
+
+
+def get_index(log_path):
+    """Load the index for the log, building or extending it as needed."""
+    index = load_index(log_path)
+    if index is None or index['log_size'] != os.path.getsize(log_path):
+        index = build_index(log_path, index)
+    return index
+
+
+def query(log_path, since=None, until=None, source=None, exceptions_only=False):
+    """Generator of the records (as bytes) in the log matching all the given conditions."""
+    index = get_index(log_path)
+    source_id = None
+    if source is not None:
+        if source not in index['sources']:
+            return
+        source_id = index['sources'].index(source)
+
+    if not index['blocks']:
+        return
+    with open(log_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for start, end, min_ts, max_ts, sources, exceptions in index['blocks']:
+            if min_ts is None:
+                continue
+            if (since and max_ts < since) or (until and min_ts > until):
+                continue
+            if source_id is not None and source_id not in sources:
+                continue
+            if exceptions_only and not exceptions:
+                continue
+
+            if exceptions_only:
+                # Seek straight to each exception record.
+                for offset in exceptions:
+                    match = _RECORD_RE.match(mm, offset)
+                    next_match = _RECORD_RE.search(mm, match.end(), end)
+                    ts = match.group(1).decode('ascii')
+                    if (not since or ts >= since) and (not until or ts <= until):
+                        yield mm[offset:next_match.start() if next_match else end]
+                continue
+
+            match = _RECORD_RE.search(mm, start, end)
+            while match:
+                next_match = _RECORD_RE.search(mm, match.end(), end)
+                ts = match.group(1).decode('ascii')
+                if ((not since or ts >= since) and (not until or ts <= until)
+                        and (source is None or _record_source(mm, match) == source)):
+                    yield mm[match.start():next_match.start() if next_match else end]
+                match = next_match
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index and query text Jotter logs.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    index_parser = subparsers.add_parser('index', help='build or update the sidecar indexes')
+    index_parser.add_argument('logs', nargs='+')
+    query_parser = subparsers.add_parser('query', help='print the matching records')
+    query_parser.add_argument('logs', nargs='+')
+    query_parser.add_argument('--since', help='earliest timestamp, "YYYY-MM-DD HH:MM:SS" or a prefix of it')
+    query_parser.add_argument('--until', help='latest timestamp, "YYYY-MM-DD HH:MM:SS" or a prefix of it')
+    query_parser.add_argument('--source', help='only entries jotted with this source_file')
+    query_parser.add_argument('--exceptions', action='store_true', help='only exception records')
+    args = parser.parse_args()
+
+    if args.command == 'index':
+        for log_path in args.logs:
+            index = get_index(log_path)
+            print('%s: %d bytes, %d blocks, %d sources' % (log_path, index['log_size'], len(index['blocks']),
+                                                            len(index['sources'])))
+        return
+
+    # Pad a partial 'until' so that e.g. "2021-09-02" includes the whole of that day.
+    until = args.until + '~' if args.until and len(args.until) < 19 else args.until
+    out = sys.stdout.buffer
+    for log_path in args.logs:
+        for record in query(log_path, args.since, until, args.source, args.exceptions):
+            if len(args.logs) > 1:
+                out.write(log_path.encode() + b': ')
+            out.write(record)
+
+
+if __name__ == '__main__':
+    main()
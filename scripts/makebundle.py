@@ -0,0 +1,195 @@
+#! /usr/bin/env python3
+#
+# Make an update bundle of the module releases for installing from the SD card.
+#
+# This file is part of micropython-usmart-sensor-application.
+# https://github.com/bensherlock/micropython-usmart-sensor-application
+#
+#
+# MIT License
+#
+# Copyright (c) 2020 Benjamin Sherlock <benjamin.sherlock@ncl.ac.uk>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Make an update bundle of the modules checked out by getsubrepos.sh, for the node to install from /sd/ota/ at boot
+without the wifi. Copy the output directory to the SD card as ota/.
+
+Each module's main/ directory goes into the bundle as <module>.tar, or as a <module>/ copy with -d, along with a
+.manifest of the git blob sha and size of each file so the node can check them and later updates from GitHub only
+download what has changed. bundle.json indexes the modules with their versions, and the sha256 of each tar.
+
+The version of a module is the tag from 'git describe --tags' in its checkout, or the .version of its main/
+directory, unless given with -v module=version. The node installs a module only if the bundle version is newer.
+
+Usage: python3 makebundle.py [-s ../main] [-o ../ota] [-d] [-m mainloop,uac_modem] [-v mainloop=v1.2.0]
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+
+INDEX = 'bundle.json'
+SKIPPED = ('.git', '__pycache__', '.version', '.manifest')
+
+
+def git_blob_sha(data):
+    return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+
+def configured_modules(source_root):
+    """Names of the modules with an OTA configuration."""
+    config_dir = os.path.join(source_root, 'config')
+    suffix = '_gitrepo_cfg.json'
+    return sorted(f[:-len(suffix)] for f in os.listdir(config_dir) if f.endswith(suffix))
+
+
+def module_version(module_root):
+    """Version of the module checked out at module_root, or None."""
+    if os.path.isdir(os.path.join(module_root, '.git')):
+        try:
+            return subprocess.check_output(['git', 'describe', '--tags'], cwd=module_root,
+                                           stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            pass
+    try:
+        with open(os.path.join(module_root, 'main', '.version')) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def read_files(main_dir):
+    """Relative path to contents of the files below main_dir, and the relative paths of its subdirectories."""
+    files = {}
+    directories = []
+    for directory, dirnames, filenames in os.walk(main_dir):
+        dirnames[:] = sorted(d for d in dirnames if d not in SKIPPED)
+        relative = os.path.relpath(directory, main_dir).replace(os.sep, '/')
+        prefix = '' if relative == '.' else relative + '/'
+        directories.extend(prefix + d for d in dirnames)
+        for filename in sorted(filenames):
+            if filename not in SKIPPED:
+                with open(os.path.join(directory, filename), 'rb') as f:
+                    files[prefix + filename] = f.read()
+    return files, directories
+
+
+def make_manifest(files):
+    """The .manifest of path to [sha, size] as the OTA updater saves it."""
+    manifest = {path: [git_blob_sha(data), len(data)] for (path, data) in files.items()}
+    return json.dumps(manifest, sort_keys=True).encode()
+
+
+def write_tar(path, files, directories):
+    """Write an uncompressed ustar archive of the files below main/, as 'tar -cf main.tar main' would."""
+    with tarfile.open(path, mode='w', format=tarfile.USTAR_FORMAT) as tar:
+        for name in ['main'] + ['main/' + d for d in directories]:
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            tar.addfile(info)
+        for (name, data) in sorted(files.items()):
+            info = tarfile.TarInfo('main/' + name)
+            info.size = len(data)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(data))
+
+
+def write_directory(path, files, directories):
+    os.mkdir(path)
+    for directory in directories:
+        os.makedirs(os.path.join(path, directory), exist_ok=True)
+    for (name, data) in files.items():
+        with open(os.path.join(path, name), 'wb') as f:
+            f.write(data)
+
+
+def make_bundle(modules, output, as_directory=False):
+    """Write a bundle of modules, module name to (version, main directory), into the output directory, which is
+    replaced. Returns the bundle index."""
+    if os.path.exists(output):
+        if os.listdir(output) and not os.path.exists(os.path.join(output, INDEX)):
+            raise ValueError('Not replacing a directory that is not a bundle: ' + output)
+        shutil.rmtree(output)
+    os.makedirs(output)
+
+    index = {}
+    for (module, (version, main_dir)) in sorted(modules.items()):
+        files, directories = read_files(main_dir)
+        files['.manifest'] = make_manifest(files)
+        if as_directory:
+            write_directory(os.path.join(output, module), files, directories)
+            index[module] = {'version': version, 'path': module}
+        else:
+            path = os.path.join(output, module + '.tar')
+            write_tar(path, files, directories)
+            with open(path, 'rb') as f:
+                sha256 = hashlib.sha256(f.read()).hexdigest()
+            index[module] = {'version': version, 'path': module + '.tar', 'sha256': sha256}
+
+    # The index is written last as it is what the node looks for.
+    with open(os.path.join(output, INDEX), 'w') as f:
+        json.dump({'modules': index}, f, indent=1, sort_keys=True)
+    return index
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Make an update bundle for installing from the SD card.')
+    parser.add_argument('-s', '--source', default=os.path.join(script_dir, '..', 'main'), help='source tree')
+    parser.add_argument('-o', '--output', default=os.path.join(script_dir, '..', 'ota'), help='bundle directory')
+    parser.add_argument('-d', '--directory', action='store_true', help='copy the modules as directories, not tars')
+    parser.add_argument('-m', '--modules', help='comma separated modules (default all configured)')
+    parser.add_argument('-v', '--version', action='append', default=[], help='module=version, may be repeated')
+    args = parser.parse_args()
+
+    versions = dict(v.split('=', 1) for v in args.version)
+    names = args.modules.split(',') if args.modules else configured_modules(args.source)
+    modules = {}
+    for module in names:
+        module_root = os.path.join(args.source, module)
+        main_dir = os.path.join(module_root, 'main')
+        version = versions.get(module) or module_version(module_root)
+        if not os.path.isdir(main_dir) or not version:
+            print('skipping ' + module + (': no version' if os.path.isdir(main_dir) else ': not checked out'))
+            continue
+        modules[module] = (version, main_dir)
+
+    if not modules:
+        print('no modules to bundle')
+        sys.exit(1)
+    try:
+        index = make_bundle(modules, args.output, args.directory)
+    except ValueError as the_exception:
+        print(the_exception)
+        sys.exit(1)
+    for (module, entry) in sorted(index.items()):
+        print('%-20s %s' % (module, entry['version']))
+    print('bundle written to ' + args.output + ', copy it to the SD card as ota/')
+
+
+if __name__ == '__main__':
+    main()
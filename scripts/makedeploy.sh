@@ -1,16 +1,108 @@
 #!/bin/bash
 
-# Make a deployment. Copy all files below main/ into a deploy directory, but not the .git repos. 
+# Make a deployment. Copy all files below main/ into a deploy directory, but not the .git repos.
+# Then cross compile the modules to .mpy with mpy-cross so the board doesn't have to compile them at import.
+#
+# Usage: ./makedeploy.sh [-s] [-k] [-O level] [-a arch] [-f manifest.py]
+#   -s           Source only, copy the .py files without compiling (the old behaviour).
+#   -k           Keep the .py source in a deploy-src directory. Not alongside the .mpy files, as the board would
+#                import the .py in preference to the .mpy.
+#   -O level     mpy-cross optimisation level (default 0).
+#   -a arch      mpy-cross -march for native code, e.g. armv7emsp for the PYBD (default none).
+#   -f manifest  Also write a frozen manifest of the modules for building them into a custom firmware.
+#
+# boot.py and main.py are always kept as source as the firmware runs them by file name.
 
+SOURCE_ONLY=0
+KEEP_SOURCE=0
+OPT_LEVEL=0
+ARCH=""
+MANIFEST=""
 
+while getopts "skO:a:f:" opt; do
+    case $opt in
+        s) SOURCE_ONLY=1 ;;
+        k) KEEP_SOURCE=1 ;;
+        O) OPT_LEVEL=$OPTARG ;;
+        a) ARCH=$OPTARG ;;
+        f) MANIFEST=$(realpath -m "$OPTARG") ;;
+        *) echo "Usage: $0 [-s] [-k] [-O level] [-a arch] [-f manifest.py]"; exit 1 ;;
+    esac
+done
 
 # Move out of scripts dir
 cd ..
 
-rm -rf deploy
+rm -rf deploy deploy-src
 mkdir deploy
 
 cp -r main/* deploy/
 
 rm -rf deploy/*/.git
 #ls deploy/*/.git
+find deploy -name '__pycache__' -prune -exec rm -rf {} \;
+
+if [ -n "$MANIFEST" ]; then
+    MAIN_DIR=$(realpath main)
+    echo "# Frozen manifest generated by scripts/makedeploy.sh" > "$MANIFEST"
+    (cd main && find . -path '*/.git' -prune -o -name '*.py' -print | sed 's|^\./||' | sort) | while read -r f; do
+        if [ "$f" != "boot.py" ] && [ "$f" != "main.py" ]; then
+            echo "freeze('$MAIN_DIR', '$f', opt=$OPT_LEVEL)" >> "$MANIFEST"
+        fi
+    done
+    echo "Wrote frozen manifest $MANIFEST"
+fi
+
+if [ $SOURCE_ONLY -eq 1 ]; then
+    exit 0
+fi
+
+if ! command -v mpy-cross > /dev/null; then
+    echo "mpy-cross not found. Install it (pip install mpy-cross) matching the firmware version or use -s."
+    exit 1
+fi
+
+MPY_ARGS="-O$OPT_LEVEL"
+if [ -n "$ARCH" ]; then
+    MPY_ARGS="$MPY_ARGS -march=$ARCH"
+fi
+
+PY_TOTAL=0
+MPY_TOTAL=0
+COUNT=0
+FAILED=0
+START=$(date +%s%N)
+printf "%-60s %8s %8s\n" "File" "py" "mpy"
+while read -r f; do
+    rel=${f#deploy/}
+    if [ "$rel" == "boot.py" ] || [ "$rel" == "main.py" ]; then
+        continue
+    fi
+    mpy="${f%.py}.mpy"
+    if ! mpy-cross $MPY_ARGS -s "$rel" -o "$mpy" "$f"; then
+        echo "Failed to compile $rel"
+        FAILED=$((FAILED + 1))
+        continue
+    fi
+    py_size=$(stat -c %s "$f")
+    mpy_size=$(stat -c %s "$mpy")
+    printf "%-60s %8d %8d\n" "$rel" "$py_size" "$mpy_size"
+    PY_TOTAL=$((PY_TOTAL + py_size))
+    MPY_TOTAL=$((MPY_TOTAL + mpy_size))
+    COUNT=$((COUNT + 1))
+    if [ $KEEP_SOURCE -eq 1 ]; then
+        mkdir -p "deploy-src/$(dirname "$rel")"
+        mv "$f" "deploy-src/$rel"
+    else
+        rm "$f"
+    fi
+done < <(find deploy -name '*.py' | sort)
+END=$(date +%s%N)
+
+printf "%-60s %8d %8d\n" "Total ($COUNT files)" "$PY_TOTAL" "$MPY_TOTAL"
+echo "Compiled with mpy-cross $MPY_ARGS in $(( (END - START) / 1000000 )) ms"
+
+if [ $FAILED -ne 0 ]; then
+    echo "$FAILED files failed to compile"
+    exit 1
+fi